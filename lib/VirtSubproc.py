@@ -34,19 +34,59 @@ import time
 import pipes
 import socket
 import shutil
+import hashlib
+import select
+import threading
+import fcntl
+import fnmatch
+import stat
+import queue
+import selectors
+import contextlib
+import importlib.machinery
+import importlib.util
 
 import adtlog
+import adt_cache
+import adt_trace
 
 progname = "<VirtSubproc>"
 devnull_read = open('/dev/null', 'r')
 caller = __main__
 copy_timeout = int(os.getenv('ADT_VIRT_COPY_TIMEOUT', '300'))
+# directory copies through auxverb get compressed with the first of these
+# programs which is installed on both the host and the testbed, if the virt
+# server sets copy_compress (when its auxverb goes over the network);
+# $ADT_VIRT_COPY_COMPRESS overrides this with a list of programs or "none"
+copy_compressors = ['zstd', 'lz4', 'gzip']
+copy_compress = False
+copy_compressor = None  # negotiated program, '' for none, None if unknown
+copy_bufsize = 1048576
+FICLONE = 0x40049409  # ioctl for creating a reflink, from linux/fs.h
 
 downtmp_open = None  # downtmp after opening testbed
 downtmp = None  # current downtmp (None after close)
 auxverb = None  # prefix to run command argv in testbed
 cleaning = False
 in_mainloop = False
+state_cache = None  # adt_cache.Cache of testbed states, if enabled
+state_entry = None  # pinned state cache entry which the testbed runs from
+expect_keep = 1048576  # bytes of recent output which expect() keeps
+expect_regex_window = 4096  # bytes of old output which regexes rescan
+
+# Commands prefixed with "#<request ID>" get their reply prefixed with the
+# same ID. These commands then run in a thread, so that the caller can
+# pipeline several of them and get their replies in completion order; all
+# other commands wait until the running requests have finished.
+concurrent_commands = {'copyup', 'copydown', 'execute-many'}
+input_fd = 0  # file descriptor from which we read commands
+input_buf = b''
+selector = None  # selectors.DefaultSelector() for input and wakeup_fds
+wakeup_fds = None  # pipe through which request threads wake up the loop
+requests = {}  # request ID -> thread of running concurrent requests
+replies = queue.Queue()  # (request ID, reply or exception) of finished ones
+sigpipe_handler = None  # SIGPIPE handler while requests are running
+_compressor_lock = threading.Lock()
 
 
 class Quit(RuntimeError):
@@ -57,20 +97,116 @@ class Quit(RuntimeError):
 
 
 class Timeout(RuntimeError):
-    pass
 
+    def __init__(self, deadline=None):
+        self.deadline = deadline
 
-def alarm_handler(*a):
-    raise Timeout()
 
+class Deadline:
+    '''Point in time (on the monotonic clock) when an operation times out'''
 
-def timeout_start(to):
-    signal.signal(signal.SIGALRM, alarm_handler)
-    signal.alarm(to)
+    def __init__(self, secs):
+        self.secs = secs
+        self.at = time.monotonic() + secs
+
+    def remaining(self):
+        return self.at - time.monotonic()
+
+
+# stack of active Deadlines of each thread, see timeout()
+_deadlines = threading.local()
 
 
-def timeout_stop():
-    signal.alarm(0)
+def _active_deadlines():
+    try:
+        return _deadlines.stack
+    except AttributeError:
+        _deadlines.stack = []
+        return _deadlines.stack
+
+
+def time_left():
+    '''Return seconds until the earliest deadline of the current thread
+
+    Return None if there is no active timeout() block. Raise Timeout if the
+    deadline has passed.
+    '''
+    stack = _active_deadlines()
+    if not stack:
+        return None
+    earliest = min(stack, key=lambda d: d.at)
+    left = earliest.remaining()
+    if left <= 0:
+        raise Timeout(earliest)
+    return left
+
+
+def sleep(secs):
+    '''time.sleep() which raises Timeout when a deadline passes'''
+
+    left = time_left()
+    if left is not None and left < secs:
+        time.sleep(left)
+        time_left()
+    else:
+        time.sleep(secs)
+
+
+def wait_ready(probe, timeout_sec, what, delay=0.1, max_delay=5, name=None):
+    '''Wait until probe() returns a true value, and return that
+
+    This is the common way for virt servers to wait until a testbed (or a
+    service in it) is ready. probe() gets called right away, and then again
+    with exponentially growing intervals from delay up to max_delay seconds.
+    A Timeout from probe() (e. g. of a command which it runs) counts as "not
+    ready". The time until the testbed got ready is logged and traced with
+    name (default: what).
+
+    If it does not get ready within timeout_sec, bomb(), or raise Timeout if
+    what is None.
+    '''
+    name = name or what or 'testbed'
+    start = time.time()
+    probes = 0
+    with adt_trace.span('wait ready', 'virt-ready', what=name) as span, \
+            timeout(timeout_sec, what and 'timed out waiting for %s' % what):
+        while True:
+            probes += 1
+            try:
+                result = probe()
+            except Timeout:
+                time_left()
+                result = None
+            if result:
+                break
+            sleep(delay)
+            delay = min(delay * 2, max_delay)
+        span.update(probes=probes, seconds=time.time() - start)
+    adtlog.debug('%s ready after %.2f s (%i probes)' %
+                 (name, time.time() - start, probes))
+    return result
+
+
+# Shell command which prints the boot state of a testbed: "systemd <state>"
+# if it runs systemd, otherwise "runlevel <runlevel output>"
+boot_state_command = ('if [ -d /run/systemd/system ]; then echo systemd '
+                      '$(systemctl is-system-running 2>/dev/null); '
+                      'else echo runlevel $(runlevel 2>/dev/null); fi')
+
+
+def booted(state):
+    '''Check output of boot_state_command for a completely booted system
+
+    For systemd this means that all startup jobs are done (even if some of
+    them failed); for SysV init or upstart the runlevel must be numeric,
+    i. e. not "unknown" or "S".
+    '''
+    words = state.split()
+    if not words:
+        return False
+    if words[0] == 'systemd':
+        return words[1:2] in (['running'], ['degraded'], ['maintenance'])
+    return len(words) > 1 and words[-1].isdigit()
 
 
 class FailedCmd(RuntimeError):
@@ -99,9 +235,17 @@ def cmdnumargs(c, ce, nargs=0, noptargs=0):
         bomb("too many arguments to command `%s'" % ce[0])
 
 
+def call_hook(name, *args):
+    '''Call the virt server's hook_<name>() and trace it'''
+
+    with adt_trace.span('hook_' + name, 'virt-hook'):
+        return getattr(caller, 'hook_' + name)(*args)
+
+
 def cmd_capabilities(c, ce):
     cmdnumargs(c, ce)
-    return caller.hook_capabilities()
+    return caller.hook_capabilities() + ['execute-many', 'copy-exclude',
+                                         'pipeline']
 
 
 def cmd_quit(c, ce):
@@ -125,32 +269,98 @@ def cmd_print_execute_command(c, ce):
     return [','.join(map(url_quote, auxverb))]
 
 
+def cmd_execute_many(c, ce):
+    '''Run several short commands in the testbed with a single auxverb call
+
+    Arguments are the timeout in seconds, then one argument per command with
+    the comma-separated url-encoded argv. Return "exitcode,stdout,stderr"
+    with url-encoded stdout/stderr for each command.
+    '''
+    cmdnumargs(c, ce, 1, None)
+    if not downtmp:
+        bomb("`execute-many' when not open")
+    try:
+        timeout_secs = int(c[1])
+    except ValueError:
+        bomb("invalid timeout `%s' for `execute-many'" % c[1])
+    argvs = [list(map(url_unquote, a.split(','))) for a in c[2:]]
+    return ['%i,%s,%s' % (rc, url_quote(out), url_quote(err))
+            for (rc, out, err) in execute_many(argvs, timeout_secs)]
+
+
+def execute_many(argvs, timeout_secs):
+    '''Run several commands in the testbed with a single auxverb call
+
+    Return a list of (exit code, stdout bytes, stderr bytes).
+    '''
+    # run the commands one after another with stdin from /dev/null and
+    # capture their output in temporary files; then print "exitcode
+    # stdout_size stderr_size\n" followed by stdout and stderr for each
+    script = 'd=$(mktemp -d) || exit 1; trap "rm -rf $d" EXIT; '
+    for argv in argvs:
+        script += ('%s </dev/null >$d/o 2>$d/e; r=$?; '
+                   'echo $r $(wc -c < $d/o) $(wc -c < $d/e); '
+                   'cat $d/o $d/e; ' % ' '.join(map(pipes.quote, argv)))
+    try:
+        (status, out, err) = execute_timeout(
+            None, timeout_secs, auxverb + ['sh', '-c', script],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=False)
+    except Timeout:
+        raise FailedCmd(['timeout'])
+    err = err.decode('UTF-8', 'replace')
+    if status != 0:
+        bomb('execute-many failed (exit status %i): %s' % (status, err))
+    # auxverbs like ssh can print harmless warnings
+    if err:
+        adtlog.debug('execute-many: auxverb stderr: %s' % err.rstrip())
+
+    results = []
+    pos = 0
+    try:
+        for argv in argvs:
+            nl = out.index(b'\n', pos)
+            (rc, out_size, err_size) = map(int, out[pos:nl].split())
+            pos = nl + 1
+            if pos + out_size + err_size > len(out):
+                raise ValueError('truncated output')
+            results.append((rc, out[pos:pos + out_size],
+                            out[pos + out_size:pos + out_size + err_size]))
+            pos += out_size + err_size
+    except ValueError as e:
+        bomb('execute-many: cannot parse output (%s): %s' %
+             (e, out[pos:pos + 200].decode('UTF-8', 'replace')))
+    return results
+
+
 def preexecfn():
     caller.hook_forked_inchild()
 
 
-def execute_timeout(instr, timeout, *popenargs, **popenargsk):
+def execute_timeout(instr, secs, *popenargs, **popenargsk):
     '''Popen wrapper with timeout supervision
 
     If instr is given, it is fed into stdin, otherwise stdin will be /dev/null.
+    The command gets killed and Timeout raised after secs seconds (0 for no
+    time limit), or when an enclosing timeout() block expires.
 
     Return (status, stdout, stderr)
     '''
     adtlog.debug('execute-timeout: ' + ' '.join(popenargs[0]))
-    sp = subprocess.Popen(*popenargs,
-                          preexec_fn=preexecfn,
-                          universal_newlines=True,
-                          **popenargsk)
+    popenargsk.setdefault('universal_newlines', True)
     if instr is None:
-        popenargsk['stdin'] = devnull_read
-    timeout_start(timeout)
-    try:
-        (out, err) = sp.communicate(instr)
-    except Timeout:
-        sp.kill()
-        sp.wait()
-        raise
-    timeout_stop()
+        popenargsk.setdefault('stdin', devnull_read)
+    with timeout(secs):
+        sp = subprocess.Popen(*popenargs,
+                              preexec_fn=preexecfn,
+                              **popenargsk)
+        try:
+            (out, err) = sp.communicate(instr, timeout=time_left())
+        except subprocess.TimeoutExpired:
+            sp.kill()
+            sp.wait()
+            time_left()
+            raise Timeout()
     status = sp.wait()
     return (status, out, err)
 
@@ -194,18 +404,28 @@ class timeout:
     def __init__(self, secs, exit_msg=None):
         '''Context manager that times out after given number of seconds.
 
-        If exit_msg is given, the program bomb()s with that message,
-        otherwise it raises a Timeout exception.
+        secs can be fractional; 0 or None means no time limit. Blocks can be
+        nested and used in several threads at the same time. Operations in the
+        block must check for the deadline with time_left() (or use functions
+        like execute_timeout(), expect(), or sleep() which do that); they
+        raise a Timeout exception when it passes. If exit_msg is given, the
+        program bomb()s with that message instead.
         '''
         self.secs = secs
         self.exit_msg = exit_msg
+        self.deadline = None
 
     def __enter__(self):
-        timeout_start(self.secs)
+        if self.secs:
+            self.deadline = Deadline(self.secs)
+            _active_deadlines().append(self.deadline)
+        return self
 
     def __exit__(self, type_, value, traceback):
-        timeout_stop()
-        if type_ is Timeout and self.exit_msg:
+        if self.deadline:
+            _active_deadlines().remove(self.deadline)
+        if (type_ is Timeout and self.exit_msg and
+                value.deadline in (None, self.deadline)):
             bomb(self.exit_msg)
             return True
         return False
@@ -215,43 +435,101 @@ def get_unix_socket(path):
     '''Open a connected client socket to given Unix socket with a 5s timeout'''
 
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    delay = 0.01
     with timeout(5, 'Timed out waiting for %s socket\n' % path):
         while True:
             try:
                 s.connect(path)
                 break
             except socket.error:
-                continue
+                # the server usually appears quickly, but don't spin if not
+                sleep(delay)
+                delay = min(delay * 2, 0.2)
     return s
 
 
-def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
-    adtlog.debug('expect: "%s"' % search_bytes.decode())
-    what = '"%s"' % (description or search_bytes or 'data')
-    out = b''
+def _describe_pattern(pattern):
+    if pattern is None:
+        return 'data'
+    return getattr(pattern, 'pattern', pattern).decode('UTF-8', 'replace')
+
+
+def expect_any(sock, patterns, timeout_sec, description=None, echo=False):
+    '''Wait until the data from sock matches one of several patterns
+
+    patterns is a list of bytes strings, compiled bytes regular expressions,
+    or None (for "any data"). Every received byte is only scanned once, plus
+    the preceding bytes which a match could start in (len(pattern) - 1 for
+    strings, expect_regex_window for regular expressions). Only the last
+    expect_keep bytes of the output are kept.
+
+    Return (index of the pattern which matched first, output). On timeout or
+    when sock gets closed, raise Timeout or bomb() if a description is given.
+    '''
+    adtlog.debug('expect: %s' % ' | '.join(
+        '"%s"' % _describe_pattern(p) for p in patterns))
+    what = '"%s"' % (description or
+                     ' | '.join(map(_describe_pattern, patterns)))
+    out = bytearray()
+    scanned = 0  # bytes of out which got searched already
     with timeout(timeout_sec,
                  description and ('timed out waiting for %s' % what) or None):
         while True:
-            block = sock.recv(4096)
-            if not block:
-                time.sleep(0.1)
+            if not select.select([sock], [], [], time_left())[0]:
+                time_left()
                 continue
+            block = sock.recv(65536)
+            if not block:
+                adtlog.debug('expect: connection closed while waiting for %s'
+                             % what)
+                if description:
+                    bomb('connection closed while waiting for %s' % what)
+                raise Timeout()
             if echo:
                 sys.stderr.buffer.write(block)
+                sys.stderr.buffer.flush()
             out += block
-            if search_bytes is None or search_bytes in out:
-                adtlog.debug('expect: found "%s"' % what)
-                break
 
-    return out
+            found = None
+            for (i, p) in enumerate(patterns):
+                if p is None:
+                    pos = 0
+                elif isinstance(p, bytes):
+                    pos = out.find(p, max(scanned - len(p) + 1, 0))
+                else:
+                    m = p.search(out, max(scanned - expect_regex_window, 0))
+                    pos = -1
+                    if m:
+                        pos = m.start()
+                if pos >= 0 and (found is None or pos < found[1]):
+                    found = (i, pos)
+            if found:
+                adtlog.debug('expect: found "%s"' %
+                             _describe_pattern(patterns[found[0]]))
+                return (found[0], bytes(out))
+
+            # bound the memory and the rescanning of a long console output
+            if len(out) > 2 * expect_keep:
+                del out[:len(out) - expect_keep]
+            scanned = len(out)
+
+
+def expect(sock, search_bytes, timeout_sec, description=None, echo=False):
+    '''Wait until the data from sock contains search_bytes
+
+    search_bytes can also be a compiled regular expression, or None for "any
+    data". Return the output, see expect_any() for details.
+    '''
+    return expect_any(sock, [search_bytes], timeout_sec, description, echo)[1]
 
 
 def cmd_open(c, ce):
-    global auxverb, downtmp, downtmp_open
+    global auxverb, downtmp, downtmp_open, copy_compressor
     cmdnumargs(c, ce)
     if downtmp:
         bomb("`open' when already open")
-    caller.hook_open()
+    copy_compressor = None
+    call_hook('open')
     adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
     downtmp = caller.hook_downtmp(downtmp_open)
     if downtmp_open and downtmp_open != downtmp:
@@ -295,7 +573,83 @@ def cmd_revert(c, ce):
         bomb("`revert' when not open")
     if 'revert' not in caller.hook_capabilities():
         bomb("`revert' when `revert' not advertised")
-    caller.hook_revert()
+    call_hook('revert')
+    use_state(None)
+    downtmp = caller.hook_downtmp(downtmp_open)
+    if downtmp_open and downtmp_open != downtmp:
+        bomb('virt-runner failed to restore downtmp path %s, gave %s instead'
+             % (downtmp_open, downtmp))
+    adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
+
+    return [downtmp]
+
+
+def init_state_cache():
+    '''Set up the testbed state cache, if requested by the caller
+
+    adt-run passes --state-cache and --state-cache-size down via
+    $ADT_VIRT_STATE_CACHE and $ADT_VIRT_STATE_CACHE_SIZE (in MiB). Every
+    virtualization server gets its own subdirectory, as entries can refer to
+    backend specific resources like container images.
+    '''
+    global state_cache
+
+    path = os.getenv('ADT_VIRT_STATE_CACHE')
+    if not path or not hasattr(caller, 'hook_save_state'):
+        return
+    size = int(os.getenv('ADT_VIRT_STATE_CACHE_SIZE', '10240')) * 1048576
+    state_cache = adt_cache.Cache(
+        os.path.join(path, os.path.basename(sys.argv[0])), size,
+        getattr(caller, 'hook_forget_state', None))
+
+
+def state_cache_key(c, ce):
+    cmdnumargs(c, ce, 1)
+    if not downtmp:
+        bomb("`%s' when not open" % ce[0])
+    if 'state-cache' not in caller.hook_capabilities():
+        bomb("`%s' when `state-cache' not advertised" % ce[0])
+    # the saved state is only valid for the base image it was created from
+    return hashlib.sha256(('%s\n%s' % (caller.hook_state_base(), c[1])).encode(
+        'UTF-8')).hexdigest()
+
+
+def cmd_save_state(c, ce):
+    key = state_cache_key(c, ce)
+    if state_cache.lookup(key):
+        return
+    entry = state_cache.new_entry()
+    try:
+        size = call_hook('save_state', entry)
+    except Exception:
+        state_cache.discard(entry)
+        raise
+    state_cache.commit(key, entry, size)
+
+
+def use_state(entry):
+    '''Record the pinned state cache entry which the testbed now runs from
+
+    This unpins the previous one, so that it can be evicted again.
+    '''
+    global state_entry
+    if state_entry and state_entry != entry:
+        state_cache.unpin(state_entry)
+    state_entry = entry
+
+
+def cmd_restore_state(c, ce):
+    global downtmp
+    key = state_cache_key(c, ce)
+    # the testbed keeps using the entry (e. g. as backing file of the VM
+    # image), so protect it from eviction by other adt-run instances
+    entry = state_cache.lookup(key, pin=True)
+    if not entry:
+        return
+    try:
+        call_hook('restore_state', entry)
+    finally:
+        use_state(entry)
     downtmp = caller.hook_downtmp(downtmp_open)
     if downtmp_open and downtmp_open != downtmp:
         bomb('virt-runner failed to restore downtmp path %s, gave %s instead'
@@ -330,7 +684,7 @@ def cmd_reboot(c, ce):
     else:
         execute_timeout(None, 30, auxverb +
                         ['sh', '-c', '(sleep 3; reboot) >/dev/null 2>&1 &'])
-    caller.hook_wait_reboot()
+    call_hook('wait_reboot')
 
     # restore downtmp
     check_exec(['sh', '-ec', 'for d in %s; do '
@@ -352,20 +706,74 @@ def get_downtmp_host():
     return None
 
 
-def copytree(src, dst):
-    '''Like shutils.copytree(), but merges with existing dst'''
+def clone_file(src, dst):
+    '''Like shutil.copy2(), but create a reflink if possible
+
+    A reflink shares the data blocks with src until one of them gets
+    modified, so that copying is instantaneous on file systems which support
+    this (like btrfs and XFS). Fall back to copying if src and dst are on
+    different file systems, or the file system does not support reflinks.
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if stat.S_ISREG(os.lstat(src).st_mode):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                               errno.ENOTTY, errno.EBADF):
+                raise
+    return shutil.copy2(src, dst)
+
+
+def move_own(src, dst):
+    '''Move src to dst if it is owned by us and on the same file system
+
+    This is a cheap replacement for copying a temporary copy which gets
+    removed afterwards anyway. It is not done for files of other users (like
+    root in the testbed), as dst should get our ownership like with
+    copying. Return True on success.
+    '''
+    try:
+        if os.path.exists(dst) or os.lstat(src).st_uid != os.geteuid():
+            return False
+        os.rename(src, dst)
+        return True
+    except OSError as e:
+        adtlog.debug('cannot move %s to %s: %s' % (src, dst, e))
+        return False
+
+
+def copytree(src, dst, exclude=()):
+    '''Like shutils.copytree(), but merges with existing dst
 
+    Files get reflinked instead of copied if possible. Files and directories
+    matching one of the shell patterns in exclude are not copied.
+    '''
+    ignore = exclude and shutil.ignore_patterns(*exclude) or None
     if not os.path.exists(dst):
-        shutil.copytree(src, dst, symlinks=True)
+        shutil.copytree(src, dst, symlinks=True, ignore=ignore,
+                        copy_function=clone_file)
         return
 
-    for f in os.listdir(src):
+    names = os.listdir(src)
+    skip = ignore and ignore(src, names) or set()
+    for f in names:
+        if f in skip:
+            continue
         fsrc = os.path.join(src, f)
-        subprocess.check_call(['cp', '-r', '--preserve=timestamps,links',
-                               '--target-directory', dst, fsrc])
+        if exclude and os.path.isdir(fsrc) and not os.path.islink(fsrc):
+            copytree(fsrc, os.path.join(dst, f), exclude)
+        else:
+            subprocess.check_call(['cp', '-r', '--preserve=timestamps,links',
+                                   '--reflink=auto', '--target-directory',
+                                   dst, fsrc])
 
 
-def copyup_shareddir(tb, host, is_dir, downtmp_host):
+def copyup_shareddir(tb, host, is_dir, downtmp_host, exclude=()):
     adtlog.debug('copyup_shareddir: tb %s host %s is_dir %s downtmp_host %s'
                  % (tb, host, is_dir, downtmp_host))
 
@@ -373,8 +781,7 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
     tb = os.path.normpath(tb)
     downtmp_host = os.path.normpath(downtmp_host)
 
-    timeout_start(copy_timeout)
-    try:
+    with timeout(copy_timeout):
         tb_tmp = None
         if tb.startswith(downtmp):
             # translate into host path
@@ -383,29 +790,31 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
             tb_tmp = os.path.join(downtmp, os.path.basename(host))
             adtlog.debug('copyup_shareddir: tb path %s is not already in '
                          'downtmp, copying to %s' % (tb, tb_tmp))
-            check_exec(['cp', '-r', '--preserve=timestamps,links', tb, tb_tmp],
-                       downp=True)
+            check_exec(['cp', '-r', '--preserve=timestamps,links',
+                        '--reflink=auto', tb, tb_tmp], downp=True)
             # translate into host path
             tb = os.path.join(downtmp_host, os.path.basename(host))
 
         if tb == host:
             tb_tmp = None
+        elif tb_tmp and not exclude and move_own(tb, host):
+            adtlog.debug('copyup_shareddir: moved intermediate copy %s to '
+                         'destination %s' % (tb, host))
+            tb_tmp = None
         else:
             adtlog.debug('copyup_shareddir: tb(host) %s is not already at '
                          'destination %s, copying' % (tb, host))
             if is_dir:
-                copytree(tb, host)
+                copytree(tb, host, exclude)
             else:
-                shutil.copy(tb, host)
+                clone_file(tb, host)
 
         if tb_tmp:
             adtlog.debug('copyup_shareddir: rm intermediate copy: %s' % tb)
             check_exec(['rm', '-rf', tb_tmp], downp=True)
-    finally:
-        timeout_stop()
 
 
-def copydown_shareddir(host, tb, is_dir, downtmp_host):
+def copydown_shareddir(host, tb, is_dir, downtmp_host, exclude=()):
     adtlog.debug('copydown_shareddir: host %s tb %s is_dir %s downtmp_host %s'
                  % (host, tb, is_dir, downtmp_host))
 
@@ -413,10 +822,9 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
     tb = os.path.normpath(tb)
     downtmp_host = os.path.normpath(downtmp_host)
 
-    timeout_start(copy_timeout)
-    try:
+    with timeout(copy_timeout):
         host_tmp = None
-        if host.startswith(downtmp_host):
+        if host.startswith(downtmp_host) and not exclude:
             # translate into tb path
             host = downtmp + host[len(downtmp_host):]
         else:
@@ -437,9 +845,11 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
                                 break
                             counter += 1
 
-                shutil.copytree(host, host_tmp, symlinks=True)
+                shutil.copytree(host, host_tmp, symlinks=True, ignore=(
+                    exclude and shutil.ignore_patterns(*exclude) or None),
+                    copy_function=clone_file)
             else:
-                shutil.copy(host, host_tmp)
+                clone_file(host, host_tmp)
             # translate into tb path
             host = os.path.join(downtmp, os.path.basename(tb))
 
@@ -447,25 +857,139 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
             host_tmp = None
         else:
             check_exec(['rm', '-rf', tb], downp=True)
-            check_exec(['cp', '-r', '--preserve=timestamps,links', host, tb],
-                       downp=True)
+            check_exec(['cp', '-r', '--preserve=timestamps,links',
+                        '--reflink=auto', host, tb], downp=True)
         if host_tmp:
             (is_dir and shutil.rmtree or os.unlink)(host_tmp)
-    finally:
-        timeout_stop()
 
 
 def copyupdown(c, ce, upp):
-    cmdnumargs(c, ce, 2)
-    copyupdown_internal(ce[0], c[1:], upp)
+    cmdnumargs(c, ce, 2, None)
+    exclude = []
+    for opt in c[3:]:
+        if opt.startswith('exclude='):
+            exclude.append(opt[8:])
+        else:
+            bomb("unknown option `%s' for `%s'" % (opt, ce[0]))
+    copyupdown_internal(ce[0], c[1:3], upp, exclude)
+
+
+def negotiate_compressor():
+    '''Return the program for compressing directory copies through auxverb
+
+    This is the first of copy_compressors (or $ADT_VIRT_COPY_COMPRESS) which
+    is installed on both the host and the testbed, or '' if there is none or
+    compression is disabled. The result is kept until the next open.
+    '''
+    with _compressor_lock:
+        return _negotiate_compressor()
+
+
+def _negotiate_compressor():
+    global copy_compressor
+
+    if copy_compressor is not None:
+        return copy_compressor
+    copy_compressor = ''
+    prefs = os.getenv('ADT_VIRT_COPY_COMPRESS')
+    if prefs is None:
+        prefs = copy_compress and copy_compressors or []
+    else:
+        prefs = [p for p in prefs.replace(',', ' ').split() if p != 'none']
+    local = [p for p in prefs if shutil.which(p)]
+    if local:
+        out = check_exec(['sh', '-c', 'for p in %s; do if command -v $p '
+                          '>/dev/null 2>&1; then echo $p; fi; done' %
+                          ' '.join(map(pipes.quote, local))],
+                         downp=True, outp=True, timeout=copy_timeout)
+        remote = (out or '').split()
+        copy_compressor = ([p for p in local if p in remote] + [''])[0]
+    adtlog.debug('copy compression: %s' % (copy_compressor or 'none'))
+    return copy_compressor
+
+
+def grow_pipe(fd):
+    '''Enlarge the kernel buffer of a pipe to copy_bufsize, if possible'''
+
+    try:
+        # F_SETPIPE_SZ is only defined in Python >= 3.10
+        fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), copy_bufsize)
+    except OSError:
+        pass
+
+
+def copy_size(path, exclude=()):
+    '''Return the size of a file, or of the files in a directory
+
+    Files and directories which match a shell pattern in exclude are not
+    counted.
+    '''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        dirs[:] = [d for d in dirs
+                   if not any(fnmatch.fnmatch(d, e) for e in exclude)]
+        for f in files:
+            if not any(fnmatch.fnmatch(f, e) for e in exclude):
+                try:
+                    size += os.lstat(os.path.join(root, f)).st_size
+                except OSError:
+                    pass
+    return size
+
+
+@contextlib.contextmanager
+def ignore_sigpipe():
+    '''Ignore SIGPIPE in the with block
+
+    Signal handlers can only be changed in the main thread; while
+    concurrent requests run in other threads, the command loop ignores
+    SIGPIPE already.
+    '''
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    old = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGPIPE, old)
+
+
+def relay(src, dst):
+    '''Copy data from file descriptor src to dst until EOF
+
+    Return the number of copied bytes. Raise Timeout when an enclosing
+    timeout() block expires, and BrokenPipeError if dst gets closed.
+    '''
+    total = 0
+    os.set_blocking(dst, False)
+    while True:
+        if not select.select([src], [], [], time_left())[0]:
+            time_left()
+            continue
+        data = os.read(src, copy_bufsize)
+        if not data:
+            return total
+        total += len(data)
+        while data:
+            if not select.select([], [dst], [], time_left())[1]:
+                time_left()
+                continue
+            try:
+                data = data[os.write(dst, data):]
+            except BlockingIOError:
+                pass
 
 
-def copyupdown_internal(wh, sd, upp):
+def copyupdown_internal(wh, sd, upp, exclude=()):
     '''Copy up/down a file or dir.
 
     wh: 'copyup' or 'copydown'
     sd: (source, destination) paths
     upp: True for copyup, False for copydown
+    exclude: shell patterns of files to skip when copying a dir
     '''
     if not downtmp:
         bomb("%s when not open" % wh)
@@ -475,20 +999,28 @@ def copyupdown_internal(wh, sd, upp):
     if dirsp != (sd[1][-1] == '/'):
         bomb("%s paths must agree about directoryness"
              " (presence or absence of trailing /)" % wh)
+    if exclude and not dirsp:
+        bomb("%s can only exclude files when copying a directory" % wh)
 
     # if we have a shared directory, we just need to copy it from/to there; in
     # most cases, it's testbed end is already in the downtmp dir
     downtmp_host = get_downtmp_host()
     if downtmp_host:
         try:
-            if upp:
-                copyup_shareddir(sd[0], sd[1], dirsp, downtmp_host)
-            else:
-                copydown_shareddir(sd[0], sd[1], dirsp, downtmp_host)
+            with adt_trace.span(wh + ' shared dir', 'virt-copy',
+                                src=sd[0], dst=sd[1]):
+                if upp:
+                    copyup_shareddir(sd[0], sd[1], dirsp, downtmp_host,
+                                     exclude)
+                else:
+                    copydown_shareddir(sd[0], sd[1], dirsp, downtmp_host,
+                                       exclude)
         except Timeout:
             raise FailedCmd(['timeout'])
         return
 
+    setup_start = time.time()
+
     isrc = 0
     idst = 1
     ilocal = 0 + upp
@@ -497,6 +1029,7 @@ def copyupdown_internal(wh, sd, upp):
     deststdout = devnull_read
     srcstdin = devnull_read
     remfileq = pipes.quote(sd[iremote])
+    compressor = ''
     if not dirsp:
         rune = 'cat %s%s' % ('><'[upp], remfileq)
         if upp:
@@ -508,12 +1041,18 @@ def copyupdown_internal(wh, sd, upp):
                 rune += '; chmod +x -- %s' % (remfileq)
         localcmdl = ['cat']
     else:
+        compressor = negotiate_compressor()
         taropts = [None, None]
-        taropts[isrc] = '--warning=none -c .'
-        taropts[idst] = '--warning=none --preserve-permissions --extract ' \
-                        '--no-same-owner'
-
-        rune = 'cd %s; tar %s -f -' % (remfileq, taropts[iremote])
+        taropts[isrc] = ['--warning=none'] + \
+            ['--exclude=' + e for e in exclude] + ['-c', '.']
+        taropts[idst] = ['--warning=none', '--preserve-permissions',
+                         '--extract', '--no-same-owner']
+        if compressor:
+            for o in taropts:
+                o.insert(1, '--use-compress-program=' + compressor)
+
+        rune = 'cd %s; tar %s -f -' % (
+            remfileq, ' '.join(map(pipes.quote, taropts[iremote])))
         if upp:
             try:
                 os.mkdir(sd[ilocal])
@@ -525,9 +1064,8 @@ def copyupdown_internal(wh, sd, upp):
                 remfileq, remfileq)
             ) + rune
 
-        localcmdl = ['tar', '--directory', sd[ilocal]] + (
-            ('%s -f -' % taropts[ilocal]).split()
-        )
+        localcmdl = ['tar', '--directory', sd[ilocal]] + taropts[ilocal] + \
+            ['-f', '-']
     downcmdl = auxverb + ['sh', '-ec', rune]
 
     if upp:
@@ -539,26 +1077,58 @@ def copyupdown_internal(wh, sd, upp):
     adtlog.debug(str(["srcstdin", str(srcstdin), "deststdout",
                       str(deststdout), "devnull_read", devnull_read]))
 
+    # the data goes through us instead of a direct pipe, to count it and to
+    # use larger buffers
     subprocs = [None, None]
     adtlog.debug(" +< %s" % ' '.join(cmdls[0]))
     subprocs[0] = subprocess.Popen(cmdls[0], stdin=srcstdin,
                                    stdout=subprocess.PIPE,
                                    preexec_fn=preexecfn)
     adtlog.debug(" +> %s" % ' '.join(cmdls[1]))
-    subprocs[1] = subprocess.Popen(cmdls[1], stdin=subprocs[0].stdout,
+    subprocs[1] = subprocess.Popen(cmdls[1], stdin=subprocess.PIPE,
                                    stdout=deststdout,
                                    preexec_fn=preexecfn)
-    subprocs[0].stdout.close()
+    grow_pipe(subprocs[0].stdout.fileno())
+    grow_pipe(subprocs[1].stdin.fileno())
+    adt_trace.record(wh + ' setup', 'virt-copy', setup_start, src=sd[0],
+                     dst=sd[1])
     try:
-        timeout_start(copy_timeout)
-        for sdn in [1, 0]:
-            adtlog.debug(" +" + "<>"[sdn] + "?")
-            status = subprocs[sdn].wait()
-            if not (status == 0 or (sdn == 0 and status == -13)):
-                timeout_stop()
-                bomb("%s %s failed, status %d" %
-                     (wh, ['source', 'destination'][sdn], status))
-        timeout_stop()
+        with timeout(copy_timeout), \
+                adt_trace.span(wh + ' transfer', 'virt-copy', src=sd[0],
+                               dst=sd[1]) as span:
+            start = time.time()
+            wire_bytes = None
+            try:
+                # a failing destination must not kill us with SIGPIPE
+                with ignore_sigpipe():
+                    wire_bytes = relay(subprocs[0].stdout.fileno(),
+                                       subprocs[1].stdin.fileno())
+            except BrokenPipeError:
+                pass
+            finally:
+                subprocs[0].stdout.close()
+                try:
+                    subprocs[1].stdin.close()
+                except BrokenPipeError:
+                    pass
+            for sdn in [1, 0]:
+                adtlog.debug(" +" + "<>"[sdn] + "?")
+                try:
+                    status = subprocs[sdn].wait(time_left())
+                except subprocess.TimeoutExpired:
+                    raise Timeout()
+                if not (status == 0 or (sdn == 0 and status == -13)):
+                    bomb("%s %s failed, status %d" %
+                         (wh, ['source', 'destination'][sdn], status))
+            duration = time.time() - start
+            size = copy_size(sd[ilocal], exclude)
+            span.update(bytes=size, wire_bytes=wire_bytes,
+                        compressor=compressor or None)
+            adtlog.debug('%s %s: %i bytes, %i bytes transferred (%s, ratio '
+                         '%.2f) in %.2f s, %.1f MB/s', wh, sd[isrc], size,
+                         wire_bytes or 0, compressor or 'uncompressed',
+                         size / max(wire_bytes or 1, 1), duration,
+                         size / max(duration, 0.001) / 1000000)
     except Timeout:
         for sdn in [1, 0]:
             subprocs[sdn].kill()
@@ -594,44 +1164,146 @@ def cmd_shell(c, ce):
                                     stdin=sin, stdout=sout, stderr=serr)
 
 
-def command():
+def init_command_loop(fd=0):
+    '''Set up reading commands from file descriptor fd'''
+
+    global input_fd, input_buf, selector, wakeup_fds
+
+    input_fd = fd
+    input_buf = b''
+    if wakeup_fds is None:
+        wakeup_fds = os.pipe()
+        for f in wakeup_fds:
+            os.set_blocking(f, False)
+    selector = selectors.DefaultSelector()
+    selector.register(input_fd, selectors.EVENT_READ)
+    selector.register(wakeup_fds[0], selectors.EVENT_READ)
+
+
+def read_command():
+    '''Wait for the next command line from the caller and return it
+
+    While waiting, the replies of concurrent requests get sent as soon as
+    they finish.
+    '''
+    global input_buf
+
+    while b'\n' not in input_buf:
+        for (key, events) in selector.select():
+            if key.fd == input_fd:
+                try:
+                    block = os.read(input_fd, 65536)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                if not block:
+                    bomb('end of file - caller quit?')
+                input_buf += block
+            else:
+                send_replies()
+    (line, input_buf) = input_buf.split(b'\n', 1)
+    return line.decode('UTF-8')
+
+
+def reply(request_id, r):
+    if request_id is not None:
+        r = ['#' + request_id] + r
+    sys.stdout.write(' '.join(r) + '\n')
     sys.stdout.flush()
+
+
+def send_replies():
+    '''Send the replies of finished concurrent requests
+
+    A request which failed with an exception (like Quit from bomb()) raises
+    it here again.
+    '''
+    global sigpipe_handler
+
+    try:
+        while True:
+            os.read(wakeup_fds[0], 4096)
+    except BlockingIOError:
+        pass
     while True:
         try:
-            ce = sys.stdin.readline().strip()
-            # FIXME: This usually means EOF (as checked below), but with Python
-            # 3 we often get empty strings here even though this is supposed to
-            # block for new input.
-            if ce == '':
-                time.sleep(0.1)
-                continue
+            (request_id, r) = replies.get_nowait()
+        except queue.Empty:
             break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                time.sleep(0.1)
-                continue
-            else:
-                raise
-    if not ce:
-        bomb('end of file - caller quit?')
-    ce = ce.rstrip().split()
+        requests.pop(request_id).join()
+        if not requests and sigpipe_handler is not None:
+            signal.signal(signal.SIGPIPE, sigpipe_handler)
+            sigpipe_handler = None
+        if isinstance(r, BaseException):
+            raise r
+        reply(request_id, r)
+
+
+def wait_requests():
+    '''Wait until all concurrent requests have finished'''
+
+    while requests:
+        select.select([wakeup_fds[0]], [], [])
+        send_replies()
+
+
+def run_command(f, c, ce):
+    try:
+        with adt_trace.span(c[0], 'virt-server', args=c[1:]):
+            r = f(c, ce)
+        if not r:
+            r = []
+        r.insert(0, 'ok')
+    except FailedCmd as fc:
+        r = fc.e
+    return r
+
+
+def request_thread(request_id, f, c, ce):
+    try:
+        r = run_command(f, c, ce)
+    except BaseException as e:
+        r = e
+    replies.put((request_id, r))
+    os.write(wakeup_fds[1], b'x')
+
+
+def command():
+    global sigpipe_handler
+
+    sys.stdout.flush()
+    if selector is None:
+        init_command_loop()
+    line = read_command()
+    ce = line.split()
+    request_id = None
+    if ce and ce[0].startswith('#'):
+        request_id = ce.pop(0)[1:]
+        if not request_id:
+            bomb('empty request ID')
+        if request_id in requests:
+            bomb('request ID %s is already in use' % request_id)
     c = list(map(url_unquote, ce))
     if not c:
         bomb('empty commands are not permitted')
-    adtlog.debug('executing ' + ' '.join(ce))
+    adtlog.debug('executing ' + line)
     c_lookup = c[0].replace('-', '_')
     try:
         f = globals()['cmd_' + c_lookup]
     except KeyError:
         bomb("unknown command `%s'" % ce[0])
-    try:
-        r = f(c, ce)
-        if not r:
-            r = []
-        r.insert(0, 'ok')
-    except FailedCmd as fc:
-        r = fc.e
-    print(' '.join(r))
+
+    if request_id is not None and c[0] in concurrent_commands:
+        if not requests:
+            # writing to a closed pipe gets reported as BrokenPipeError
+            # instead; the request threads cannot handle the signal
+            sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        t = threading.Thread(target=request_thread, daemon=True,
+                             args=(request_id, f, c, ce))
+        requests[request_id] = t
+        t.start()
+    else:
+        wait_requests()
+        reply(request_id, run_command(f, c, ce))
 
 signal_list = [	signal.SIGHUP, signal.SIGTERM,
                 signal.SIGINT, signal.SIGPIPE]
@@ -645,12 +1317,15 @@ def sethandlers(f):
 def cleanup():
     global downtmp, cleaning
     adtlog.debug("cleanup...")
-    sethandlers(signal.SIG_DFL)
+    if caller is __main__:
+        # a Backend runs in adt-run's process, which keeps its own handlers
+        sethandlers(signal.SIG_DFL)
     # avoid recursion if something bomb()s in hook_cleanup()
     if not cleaning:
         cleaning = True
         if downtmp:
-            caller.hook_cleanup()
+            call_hook('cleanup')
+        use_state(None)
         cleaning = False
         downtmp = None
 
@@ -704,6 +1379,149 @@ def mainloop():
 
 
 def main():
+    adt_trace.enable_from_env()
+    adt_trace.process_name(os.path.basename(sys.argv[0]))
+    init_state_cache()
     ok()
     prepare()
     mainloop()
+
+
+class Backend:
+    '''Virtualization server loaded into the calling Python process
+
+    This is an alternative to main() for talking to a virt server: instead
+    of starting adt-virt-* as a subprocess and exchanging command lines with
+    it through pipes, the caller loads its module and calls its operations
+    as Python methods, avoiding the process, the quoting, and the round-trip
+    for each of them. The methods take and return unquoted values; they
+    raise Quit when the virt server bomb()s, and FailedCmd for commands
+    which the stdio transport would answer with a failure reply (like
+    "timeout").
+
+    As the virt server's state lives in this module's globals, there can only
+    be one Backend per process; creating one (like in a forked child)
+    replaces the previous one. Methods can be called from several threads,
+    but like with the "pipeline" capability, only copyup(), copydown(), and
+    execute() may run concurrently to each other.
+    '''
+    def __init__(self, argv):
+        '''Load virt server argv[0] and parse its arguments argv[1:]'''
+
+        global caller, in_mainloop, progname, copy_timeout, copy_compress
+        global copy_compressor, downtmp, downtmp_open, auxverb, state_cache
+        global state_entry
+
+        path = argv[0]
+        if '/' not in path:
+            path = shutil.which(path)
+            if not path:
+                raise Quit(16, 'virt server %s not found' % argv[0])
+        name = os.path.basename(path)
+
+        # start from a clean state, in particular in a forked child
+        progname = name
+        copy_timeout = int(os.getenv('ADT_VIRT_COPY_TIMEOUT', '300'))
+        copy_compress = False
+        copy_compressor = None
+        downtmp = downtmp_open = auxverb = state_cache = state_entry = None
+
+        loader = importlib.machinery.SourceFileLoader(
+            name.replace('-', '_'), path)
+        spec = importlib.util.spec_from_loader(loader.name, loader)
+        self.module = importlib.util.module_from_spec(spec)
+        orig_argv = sys.argv
+        sys.argv = [path] + list(argv[1:])
+        try:
+            loader.exec_module(self.module)
+            self.module.parse_args()
+            caller = self.module
+            in_mainloop = True
+            init_state_cache()
+        except SystemExit as e:
+            raise Quit(16, 'invalid arguments for %s (exit status %s)' %
+                       (name, e.code))
+        finally:
+            sys.argv = orig_argv
+
+    def _call(self, *c):
+        c = list(c)
+        f = globals()['cmd_' + c[0].replace('-', '_')]
+        with adt_trace.span(c[0], 'virt-server', args=c[1:]):
+            return f(c, c) or []
+
+    def command(self, c):
+        '''Run a protocol command with unquoted arguments
+
+        Return the reply words after "ok" like the stdio transport does,
+        i. e. still url-encoded where the protocol specifies it.
+        '''
+        return self._call(*c)
+
+    def capabilities(self):
+        return self._call('capabilities')
+
+    def open(self):
+        '''Open the testbed and return the downtmp path'''
+
+        return self._call('open')[0]
+
+    def close(self):
+        self._call('close')
+
+    def revert(self):
+        '''Revert the testbed and return the downtmp path'''
+
+        return self._call('revert')[0]
+
+    def reboot(self, prepare_only=False):
+        self._call('reboot', *(prepare_only and ['prepare-only'] or []))
+
+    def save_state(self, key):
+        self._call('save-state', key)
+
+    def restore_state(self, key):
+        '''Restore testbed state key from the state cache
+
+        Return the downtmp path, or None if the state is not cached.
+        '''
+        r = self._call('restore-state', key)
+        return r and r[0] or None
+
+    def execute_command(self):
+        '''Return the argv prefix for running a command in the testbed'''
+
+        if not downtmp:
+            bomb("`print-execute-command' when not open")
+        return list(auxverb)
+
+    def execute(self, argvs, timeout_secs):
+        '''Run several short commands in the testbed
+
+        This is the "execute-many" command; return a list of (exit code,
+        stdout bytes, stderr bytes).
+        '''
+        if not downtmp:
+            bomb("`execute-many' when not open")
+        with adt_trace.span('execute-many', 'virt-server', argvs=argvs):
+            return execute_many(argvs, timeout_secs)
+
+    def copydown(self, host, tb, exclude=()):
+        self._call('copydown', host, tb, *['exclude=' + e for e in exclude])
+
+    def copyup(self, tb, host, exclude=()):
+        self._call('copyup', tb, host, *['exclude=' + e for e in exclude])
+
+    def shell(self, cwd, env=()):
+        self._call('shell', cwd, *env)
+
+    def quit(self):
+        '''Clean up the testbed and unload the virt server'''
+
+        global caller, in_mainloop
+
+        try:
+            cleanup()
+        finally:
+            caller = __main__
+            in_mainloop = False
@@ -0,0 +1,272 @@
+# adt_aio is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+'''asyncio building blocks for talking to testbeds
+
+adt-run runs every testbed operation as a coroutine on an event loop, so
+that several operations (and host side work like log handling) can overlap,
+and timeouts are per call instead of a process global SIGALRM.
+'''
+
+import os
+import sys
+import time
+import gzip
+import errno
+import select
+import asyncio
+import subprocess
+
+import adtlog
+
+
+class Timeout(Exception):
+    pass
+
+
+class TestbedFailure(Exception):
+    '''Failure of the testbed, to be handled with Testbed.bomb()'''
+
+    def __init__(self, message, exitcode=16):
+        Exception.__init__(self, message)
+        self.message = message
+        self.exitcode = exitcode
+
+
+class LineReader:
+    '''Read lines from a pipe file descriptor
+
+    This can be used both from coroutines on an event loop (readline()) and
+    synchronously (readline_blocking()), e. g. from signal handlers which
+    interrupt a running loop; both share the same buffer. A partial line is
+    returned at EOF.
+    '''
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = b''
+        self.eof = False
+
+    def _pop_line(self):
+        i = self.buf.find(b'\n')
+        if i >= 0:
+            (l, self.buf) = (self.buf[:i + 1], self.buf[i + 1:])
+        elif self.eof:
+            (l, self.buf) = (self.buf, b'')
+        else:
+            return None
+        return l.decode('UTF-8', errors='replace')
+
+    def _read(self):
+        try:
+            block = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if block:
+            self.buf += block
+        else:
+            self.eof = True
+
+    async def readline(self, timeout=None):
+        '''Return next line (including "\\n"), or '' at EOF
+
+        Raise Timeout if no complete line arrives within timeout seconds.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            l = self._pop_line()
+            if l is not None:
+                return l
+            readable = loop.create_future()
+            loop.add_reader(self.fd, lambda: readable.done() or
+                            readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, timeout)
+            except asyncio.TimeoutError:
+                raise Timeout()
+            finally:
+                loop.remove_reader(self.fd)
+            self._read()
+
+    def readline_blocking(self, timeout=None):
+        '''Synchronous version of readline()'''
+
+        deadline = timeout and time.monotonic() + timeout
+        while True:
+            l = self._pop_line()
+            if l is not None:
+                return l
+            if deadline:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Timeout()
+            else:
+                remaining = None
+            if select.select([self.fd], [], [], remaining)[0]:
+                self._read()
+
+
+def write_stdout(block):
+    adtlog.flush_sinks()
+    sys.stdout.buffer.write(block)
+    sys.stdout.buffer.flush()
+
+
+def write_stderr(block):
+    adtlog.flush_sinks()
+    sys.stderr.buffer.write(block)
+    sys.stderr.buffer.flush()
+
+
+class OutputFile:
+    '''Output handler for run() which streams into a host file
+
+    Each block gets written to path (gzip compressed if compress is True)
+    and passed on to forward (e. g. write_stdout), if given. Once the file
+    has max_size bytes of output, the rest is dropped from it (but still
+    forwarded) and a note is appended. Only the total output size and the
+    first line are kept in memory.
+    '''
+
+    truncated_note = b'\n[... output truncated by autopkgtest ...]\n'
+
+    def __init__(self, path, forward=None, compress=False, max_size=None):
+        self.path = path
+        self.forward = forward
+        self.compress = compress
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+        self.first_line = b''
+        self._first_line_done = False
+        if compress:
+            self.f = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            self.f = open(path, 'wb')
+
+    def __call__(self, block):
+        if self.forward:
+            self.forward(block)
+
+        if not self._first_line_done:
+            i = block.find(b'\n')
+            if i >= 0:
+                self.first_line += block[:i]
+                self._first_line_done = True
+            else:
+                self.first_line += block
+            if len(self.first_line) >= 1000:
+                self.first_line = self.first_line[:1000]
+                self._first_line_done = True
+
+        if self.max_size is None:
+            self.f.write(block)
+        elif self.size < self.max_size:
+            self.f.write(block[:self.max_size - self.size])
+            if self.size + len(block) > self.max_size:
+                self.f.write(self.truncated_note)
+                self.truncated = True
+        elif block and not self.truncated:
+            # the previous block ended exactly at max_size
+            self.f.write(self.truncated_note)
+            self.truncated = True
+        self.size += len(block)
+
+    def close(self):
+        self.f.close()
+
+    def open_read(self):
+        '''Open the (closed) file for reading the output back'''
+
+        if self.compress:
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+
+def decode_output(data):
+    '''Decode captured output like Popen(universal_newlines=True)'''
+
+    return data.decode('UTF-8', errors='replace').replace(
+        '\r\n', '\n').replace('\r', '\n')
+
+
+async def _pump(stream, handler, capture):
+    while True:
+        block = await stream.read(65536)
+        if not block:
+            break
+        if capture is not None:
+            capture.append(block)
+        if handler:
+            handler(block)
+
+
+async def run(argv, capture_stdout=False, capture_stderr=False,
+              stdout_handler=write_stdout, stderr_handler=write_stderr,
+              timeout=None, on_timeout=None, wait_killed=True):
+    '''Run a command and stream its output
+
+    Output blocks are passed to stdout_handler/stderr_handler as they
+    arrive (by default, they get written to our own stdout/stderr), and
+    collected if capture_stdout/capture_stderr is True.
+
+    If the command does not finish within timeout seconds, on_timeout(proc)
+    gets called (which should kill the command), and Timeout is raised after
+    the command exited; with wait_killed=False, without waiting for it.
+
+    Return (exit code, stdout, stderr); stdout/stderr are None when not
+    captured.
+    '''
+    proc = await asyncio.create_subprocess_exec(
+        *argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = [] if capture_stdout else None
+    err = [] if capture_stderr else None
+    pumps = asyncio.gather(
+        _pump(proc.stdout, not capture_stdout and stdout_handler, out),
+        _pump(proc.stderr, not capture_stderr and stderr_handler, err))
+
+    async def finish():
+        await pumps
+        return await proc.wait()
+
+    try:
+        rc = await asyncio.wait_for(finish(), timeout)
+    except asyncio.TimeoutError:
+        if on_timeout:
+            on_timeout(proc)
+        if wait_killed:
+            await proc.wait()
+        raise Timeout()
+
+    if out is not None:
+        out = decode_output(b''.join(out))
+    if err is not None:
+        err = decode_output(b''.join(err))
+    return (rc, out, err)
+
+
+async def gather(*coros):
+    '''Run coroutines concurrently and return the list of their results'''
+
+    return await asyncio.gather(*coros)
@@ -0,0 +1,191 @@
+# adt_cache is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+import os
+import errno
+import fcntl
+import shutil
+import tempfile
+import contextlib
+
+import adtlog
+
+
+def dir_size(path):
+    '''Return the disk usage of a directory tree in bytes'''
+
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_blocks * 512
+            except OSError:
+                pass
+    return size
+
+
+class Cache:
+    '''Size bounded least recently used cache of directories
+
+    Every entry is a subdirectory of path, named after its key. Looking up an
+    entry updates its mtime, which determines the eviction order. Entries
+    which refer to resources outside of their directory (like container
+    images) record their size in a "size" file and get cleaned up by the
+    on_evict(entry_dir) callback.
+
+    The cache can be shared between concurrent processes; changes to the
+    index are serialized with a lock file. Entries which are in use (like a
+    saved VM image which is the backing file of a running VM) can be pinned
+    with lookup(key, pin=True); they do not get evicted or replaced by any
+    process until unpin().
+    '''
+
+    def __init__(self, path, max_size, on_evict=None):
+        self.path = path
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.pins = {}  # entry directory -> fd with shared lock
+        os.makedirs(path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.path, 'lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def lookup(self, key, pin=False):
+        '''Return directory of the entry for key, or None
+
+        With pin=True, the entry is protected from eviction until unpin().
+        '''
+        d = os.path.join(self.path, key)
+        with self._locked():
+            try:
+                os.utime(d)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                adtlog.debug('cache %s: miss %s' % (self.path, key))
+                return None
+            if pin and d not in self.pins:
+                fd = os.open(d, os.O_RDONLY)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                self.pins[d] = fd
+        adtlog.debug('cache %s: hit %s' % (self.path, key))
+        return d
+
+    def unpin(self, d):
+        '''Allow evicting a pinned entry directory again'''
+
+        fd = self.pins.pop(d, None)
+        if fd is not None:
+            os.close(fd)
+
+    def pinned(self, d):
+        '''Check if entry directory d is pinned by any process'''
+
+        if d in self.pins:
+            return True
+        try:
+            fd = os.open(d, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            return True
+        finally:
+            os.close(fd)
+
+    def new_entry(self):
+        '''Create a temporary directory for a new entry
+
+        Fill it and pass it to commit() or discard().
+        '''
+        return tempfile.mkdtemp(prefix='.new-', dir=self.path)
+
+    def discard(self, tmpdir):
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def commit(self, key, tmpdir, size=None):
+        '''Turn a new entry into the entry for key
+
+        size gives the size of external resources of the entry; by default,
+        the size of tmpdir is used. This replaces an already existing entry
+        for key and evicts the least recently used entries until the cache
+        fits into max_size again. If the existing entry is pinned, it is kept
+        and tmpdir gets discarded instead. Return the entry directory.
+        '''
+        if size is not None:
+            with open(os.path.join(tmpdir, 'size'), 'w') as f:
+                f.write('%i\n' % size)
+
+        d = os.path.join(self.path, key)
+        with self._locked():
+            if os.path.exists(d):
+                if self.pinned(d):
+                    adtlog.debug('cache %s: keeping pinned %s' %
+                                 (self.path, key))
+                    self.discard(tmpdir)
+                    return d
+                self._remove(d)
+            os.rename(tmpdir, d)
+            self._evict(d)
+        adtlog.debug('cache %s: stored %s' % (self.path, key))
+        return d
+
+    def entries(self):
+        '''Return list of (mtime, size, directory) of all entries'''
+
+        result = []
+        for key in os.listdir(self.path):
+            d = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.isdir(d):
+                continue
+            try:
+                with open(os.path.join(d, 'size')) as f:
+                    size = int(f.read())
+            except (IOError, OSError, ValueError):
+                size = dir_size(d)
+            result.append((os.stat(d).st_mtime, size, d))
+        return result
+
+    def _evict(self, keep):
+        entries = sorted(self.entries())
+        total = sum([e[1] for e in entries])
+        for (mtime, size, d) in entries:
+            if total <= self.max_size:
+                break
+            if d == keep or self.pinned(d):
+                continue
+            adtlog.debug('cache %s: evicting %s' %
+                         (self.path, os.path.basename(d)))
+            self._remove(d)
+            total -= size
+
+    def _remove(self, d):
+        if self.on_evict:
+            self.on_evict(d)
+        shutil.rmtree(d, ignore_errors=True)
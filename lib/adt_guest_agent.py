@@ -0,0 +1,538 @@
+# adt_guest_agent is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+'''Agent for running commands in a VM through a single byte stream
+
+adt-virt-qemu copies this file into the VM and runs it there as a persistent
+agent on a virtio-serial port (serve()). On the host, a Mux thread in the
+virt server owns the other end of that port and accepts connections from
+client() (the runcmd auxverb) on a Unix socket; it forwards each connection
+on a channel of its own, so that many commands can run concurrently over
+the one port.
+
+Everything is sent in frames of a header (channel number, frame type,
+payload length) and the payload. Frame types from the client:
+
+  x  run command (payload: NUL separated argv)
+  i  stdin data
+  e  stdin EOF
+  k  kill the command's process group (payload: signal number)
+  a  acknowledge consumed stdout/stderr bytes (payload: count)
+
+Frame types from the agent:
+
+  o  stdout data
+  r  stderr data
+  a  acknowledge consumed stdin bytes (payload: count)
+  s  exit status (payload: exit code, 128 + signal number if killed)
+
+The acknowledgements bound the data in flight to "window" bytes per command
+and direction, so that neither side needs to buffer more than that.
+
+This module must stay compatible with Python 2, as the agent runs with
+whichever Python the VM has.
+'''
+
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import subprocess
+import threading
+
+banner = b'autopkgtest-agent ready\n'
+port_name = 'org.autopkgtest.agent'
+header = struct.Struct('!IcI')
+window = 1048576  # unacknowledged bytes per command and direction
+blocksize = 65536
+
+
+def frame(channel, type_, payload=b''):
+    return header.pack(channel, type_, len(payload)) + payload
+
+
+def parse_frames(buf):
+    '''Remove complete frames from bytearray buf
+
+    Return list of (channel, type, payload).
+    '''
+    frames = []
+    while len(buf) >= header.size:
+        (channel, type_, length) = header.unpack(bytes(buf[:header.size]))
+        end = header.size + length
+        if len(buf) < end:
+            break
+        frames.append((channel, type_, bytes(buf[header.size:end])))
+        del buf[:end]
+    return frames
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def wait_fds(rlist, wlist, timeout=None):
+    '''select() which retries on signals'''
+
+    while True:
+        try:
+            return select.select(rlist, wlist, [], timeout)[:2]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+#
+# Agent (in the VM)
+#
+
+class Command:
+    '''A command which the agent runs for a channel'''
+
+    def __init__(self, channel, argv):
+        self.channel = channel
+        self.stdin_buf = bytearray()
+        self.stdin_eof = False
+        self.out_unacked = 0
+        self.outputs = {}  # fd -> frame type
+        self.files = {}  # fd -> pipe file object
+        self.stdin = None
+        self.proc = None
+        self.status = None
+        try:
+            self.proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True,
+                                         preexec_fn=self._child_setup)
+        except OSError as e:
+            self.error = ('%s: %s\n' % (argv[0].decode('UTF-8', 'replace'),
+                                        e.strerror)).encode('UTF-8')
+            self.status = e.errno == errno.ENOENT and 127 or 126
+            return
+        self.stdin = self.proc.stdin.fileno()
+        for (f, type_) in ((self.proc.stdout, b'o'), (self.proc.stderr, b'r')):
+            self.outputs[f.fileno()] = type_
+            self.files[f.fileno()] = f
+        for fd in [self.stdin] + list(self.outputs):
+            set_nonblocking(fd)
+
+    @staticmethod
+    def _child_setup():
+        # own process group for killing, and the usual SIGPIPE behaviour
+        os.setsid()
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    def close_stdin(self):
+        if self.stdin is not None:
+            self.proc.stdin.close()
+            self.stdin = None
+
+    def close_output(self, fd):
+        del self.outputs[fd]
+        self.files.pop(fd).close()
+
+    def kill(self, sig):
+        if self.proc and self.status is None:
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                pass
+
+    def poll(self):
+        '''Check if the command exited and set status'''
+
+        if self.status is None and self.proc.poll() is not None:
+            rc = self.proc.returncode
+            self.status = rc < 0 and 128 - rc or rc
+
+
+def serve(port):
+    '''Run commands for the host on file descriptor port
+
+    This returns when the host side of port gets closed.
+    '''
+    set_nonblocking(port)
+    port_in = bytearray()
+    port_out = bytearray(banner)
+    commands = {}  # channel -> Command
+
+    # wake up select() when a command exits
+    (sig_r, sig_w) = os.pipe()
+    set_nonblocking(sig_r)
+    set_nonblocking(sig_w)
+    signal.set_wakeup_fd(sig_w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+
+    def send(channel, type_, payload=b''):
+        port_out.extend(frame(channel, type_, payload))
+
+    def read_output(c, fd):
+        '''Forward available output of fd, return False if there is none'''
+
+        try:
+            data = os.read(fd, blocksize)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return False
+        if data:
+            send(c.channel, c.outputs[fd], data)
+            c.out_unacked += len(data)
+            return True
+        c.close_output(fd)
+        return False
+
+    try:
+        while True:
+            rlist = [port, sig_r]
+            wlist = port_out and [port] or []
+            for c in commands.values():
+                if c.out_unacked < window:
+                    rlist += list(c.outputs)
+                if c.stdin_buf and c.stdin is not None:
+                    wlist.append(c.stdin)
+            (r, w) = wait_fds(rlist, wlist)
+
+            if sig_r in r:
+                try:
+                    while os.read(sig_r, 4096):
+                        pass
+                except OSError:
+                    pass
+
+            if port in r:
+                try:
+                    data = os.read(port, blocksize)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    data = None
+                if data == b'':
+                    break
+                port_in.extend(data or b'')
+                for (channel, type_, payload) in parse_frames(port_in):
+                    c = commands.get(channel)
+                    if type_ == b'x':
+                        if c is None:
+                            c = Command(channel, payload.split(b'\0'))
+                            commands[channel] = c
+                            if c.proc is None:
+                                send(channel, b'r', c.error)
+                    elif c is None:
+                        # command already finished
+                        continue
+                    elif type_ == b'i':
+                        if c.stdin is not None:
+                            c.stdin_buf.extend(payload)
+                        else:
+                            send(channel, b'a', str(len(payload)).encode())
+                    elif type_ == b'e':
+                        c.stdin_eof = True
+                    elif type_ == b'k':
+                        c.kill(int(payload))
+                    elif type_ == b'a':
+                        c.out_unacked -= int(payload)
+
+            for c in list(commands.values()):
+                if c.stdin is not None and c.stdin in w:
+                    try:
+                        n = os.write(c.stdin, bytes(c.stdin_buf[:blocksize]))
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            n = 0
+                        elif e.errno == errno.EPIPE:
+                            # the command does not want any more input
+                            n = len(c.stdin_buf)
+                            c.close_stdin()
+                        else:
+                            raise
+                    if n:
+                        del c.stdin_buf[:n]
+                        send(c.channel, b'a', str(n).encode())
+                if c.stdin_eof and not c.stdin_buf:
+                    c.close_stdin()
+                for fd in list(c.outputs):
+                    if fd in r and c.out_unacked < window:
+                        read_output(c, fd)
+
+                if c.proc is not None:
+                    c.poll()
+                if c.status is not None:
+                    # forward what the command wrote before it exited, but
+                    # don't wait for background processes which inherited
+                    # stdout/stderr
+                    for fd in list(c.outputs):
+                        while c.out_unacked < window and read_output(c, fd):
+                            pass
+                        if c.out_unacked < window and fd in c.outputs:
+                            c.close_output(fd)
+                    if not c.outputs:
+                        c.close_stdin()
+                        send(c.channel, b's', str(c.status).encode())
+                        del commands[c.channel]
+
+            if port in w:
+                try:
+                    n = os.write(port, bytes(port_out[:blocksize]))
+                    del port_out[:n]
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+    finally:
+        for c in commands.values():
+            c.kill(signal.SIGKILL)
+        signal.set_wakeup_fd(-1)
+        os.close(sig_r)
+        os.close(sig_w)
+
+
+def find_port(name=port_name):
+    '''Return the device of the virtio-serial port with given name'''
+
+    base = '/sys/class/virtio-ports'
+    for port in sorted(os.listdir(base)):
+        try:
+            with open(os.path.join(base, port, 'name')) as f:
+                if f.read().strip() == name:
+                    return os.path.join('/dev', port)
+        except IOError:
+            pass
+    return None
+
+
+def main():
+    # like the root shell on ttyS1, which the agent got started from
+    if 'HOME' not in os.environ:
+        import pwd
+        os.environ['HOME'] = pwd.getpwuid(0).pw_dir
+    path = find_port()
+    if not path:
+        sys.stderr.write('no virtio-serial port %s\n' % port_name)
+        sys.exit(1)
+    serve(os.open(path, os.O_RDWR))
+
+
+#
+# Host side
+#
+
+class Mux:
+    '''Forward client connections on a Unix socket to the agent
+
+    agent is the connected socket to the agent's port, initial the data
+    which was already received from it after the banner. Clients connect to
+    Unix socket path, and get a channel each. A thread relays their frames
+    to the agent and back; when a client disconnects before its command
+    exited, the command gets killed. When the agent's port gets closed, all
+    clients get disconnected.
+    '''
+    def __init__(self, agent, path, initial=b''):
+        self.agent = agent
+        self.path = path
+        self.agent_in = bytearray(initial)
+        self.agent_out = bytearray()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        # channel -> [socket, input bytearray, output bytearray]
+        self.clients = {}
+        self.finished = set()  # channels of exited commands
+        self.last_channel = 0
+        self.wakeup = os.pipe()
+        for s in (self.agent, self.listener):
+            s.setblocking(False)
+        self.thread = threading.Thread(target=self.run, name='agent mux')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        os.write(self.wakeup[1], b'x')
+        self.thread.join()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def _disconnect(self, channel):
+        client = self.clients.pop(channel)
+        client[0].close()
+        if channel in self.finished:
+            self.finished.discard(channel)
+        else:
+            self.agent_out.extend(frame(channel, b'k',
+                                        str(signal.SIGKILL).encode()))
+
+    def run(self):
+        try:
+            self._loop()
+        finally:
+            for client in self.clients.values():
+                client[0].close()
+            self.clients.clear()
+            self.listener.close()
+            self.agent.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _loop(self):
+        while True:
+            rlist = [self.wakeup[0], self.listener, self.agent]
+            wlist = self.agent_out and [self.agent] or []
+            for client in self.clients.values():
+                rlist.append(client[0])
+                if client[2]:
+                    wlist.append(client[0])
+            (r, w) = wait_fds(rlist, wlist)
+
+            if self.wakeup[0] in r:
+                return
+
+            if self.listener in r:
+                try:
+                    (sock, addr) = self.listener.accept()
+                except socket.error:
+                    sock = None
+                if sock:
+                    sock.setblocking(False)
+                    self.last_channel += 1
+                    self.clients[self.last_channel] = [sock, bytearray(),
+                                                       bytearray()]
+
+            for (channel, client) in list(self.clients.items()):
+                if client[0] in w:
+                    try:
+                        del client[2][:client[0].send(client[2])]
+                    except socket.error as e:
+                        if e.errno != errno.EAGAIN:
+                            self._disconnect(channel)
+                            continue
+                if client[0] in r:
+                    try:
+                        data = client[0].recv(blocksize)
+                    except socket.error as e:
+                        data = e.errno == errno.EAGAIN and None or b''
+                    if data == b'':
+                        self._disconnect(channel)
+                        continue
+                    client[1].extend(data or b'')
+                    for (_, type_, payload) in parse_frames(client[1]):
+                        self.agent_out.extend(frame(channel, type_, payload))
+
+            if self.agent in r:
+                try:
+                    data = self.agent.recv(blocksize)
+                except socket.error as e:
+                    data = e.errno == errno.EAGAIN and None or b''
+                if data == b'':
+                    # VM got shut down or rebooted
+                    return
+                self.agent_in.extend(data or b'')
+            for (channel, type_, payload) in parse_frames(self.agent_in):
+                client = self.clients.get(channel)
+                if client is None:
+                    # client already disconnected
+                    continue
+                client[2].extend(frame(channel, type_, payload))
+                if type_ == b's':
+                    self.finished.add(channel)
+
+            if self.agent in w:
+                try:
+                    del self.agent_out[:self.agent.send(self.agent_out)]
+                except socket.error as e:
+                    if e.errno != errno.EAGAIN:
+                        return
+
+
+def client(path, argv):
+    '''Run argv through the agent behind Mux socket path
+
+    stdin is forwarded to the command, its stdout and stderr to ours. Return
+    its exit code, or 255 if the connection to the agent failed (like ssh).
+    '''
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error as e:
+        sys.stderr.write('cannot connect to guest agent: %s\n' % e)
+        return 255
+    s.sendall(frame(0, b'x', b'\0'.join(map(os.fsencode, argv))))
+
+    stdin = 0
+    try:
+        os.fstat(stdin)
+    except OSError:
+        # closed stdin
+        s.sendall(frame(0, b'e'))
+        stdin = None
+    outputs = {b'o': 1, b'r': 2}
+    in_unacked = 0
+    buf = bytearray()
+    while True:
+        rlist = [s]
+        if stdin is not None and in_unacked < window:
+            rlist.append(stdin)
+        r = wait_fds(rlist, [])[0]
+        if stdin in r:
+            data = os.read(stdin, blocksize)
+            if data:
+                s.sendall(frame(0, b'i', data))
+                in_unacked += len(data)
+            else:
+                s.sendall(frame(0, b'e'))
+                stdin = None
+        if s in r:
+            data = s.recv(blocksize)
+            if not data:
+                sys.stderr.write('lost connection to guest agent\n')
+                return 255
+            buf.extend(data)
+            consumed = 0
+            for (_, type_, payload) in parse_frames(buf):
+                if type_ in outputs:
+                    try:
+                        write_all(outputs[type_], payload)
+                    except OSError as e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                    consumed += len(payload)
+                elif type_ == b'a':
+                    in_unacked -= int(payload)
+                elif type_ == b's':
+                    return int(payload)
+            if consumed:
+                s.sendall(frame(0, b'a', str(consumed).encode()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+# adt_proxy is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+import os
+import re
+import shutil
+import struct
+import hashlib
+import ipaddress
+import tempfile
+import threading
+import socketserver
+import http.server
+import urllib.request
+import urllib.error
+import urllib.parse
+
+import adtlog
+import adt_cache
+
+# URLs of files which never change, so that we can cache them; indexes like
+# Release or Packages pass through
+cacheable_re = re.compile(
+    r'(\.(u?deb|dsc|diff\.gz|tar\.[a-z0-9]+)|/by-hash/.*)$')
+
+# testbeds request this to check whether they can reach the proxy
+probe_url = 'http://autopkgtest.proxy/'
+
+# headers which must not be forwarded by proxies (RFC 2616, 13.5.1)
+hop_by_hop = set(['connection', 'keep-alive', 'proxy-authenticate',
+                  'proxy-authorization', 'te', 'trailers',
+                  'transfer-encoding', 'upgrade', 'proxy-connection'])
+
+
+loopback = ipaddress.IPv4Network('127.0.0.0/8')
+
+
+class ProxyServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def verify_request(self, request, client_address):
+        # only accept clients from the network we listen on
+        if ipaddress.ip_address(client_address[0]) in self.network:
+            return True
+        adtlog.debug('package proxy: rejecting client %s on %s' %
+                     (client_address[0], self.network))
+        return False
+
+
+class ProxyRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.proxy.handle(self, True)
+
+    def do_HEAD(self):
+        self.server.proxy.handle(self, False)
+
+    def log_message(self, format, *args):
+        adtlog.debug('package proxy: ' + format % args)
+
+
+class PackageProxy:
+    '''Caching HTTP proxy for apt
+
+    Package files are kept in a content addressed adt_cache.Cache in
+    cache_dir, with a maximum size of max_size bytes; the .urls/
+    subdirectory maps hashes of URLs to the hash of their contents.
+
+    The proxy listens on a random port on 127.0.0.1, and on the host
+    addresses which get added with listen(); there it only accepts clients
+    from the directly connected network of that address. It only forwards
+    requests to the archive hosts which get added with add_archives(), so
+    that it cannot be used to reach arbitrary hosts. Requests are served in
+    background threads until stop() is called.
+    '''
+
+    def __init__(self, cache_dir, max_size):
+        self.cache = adt_cache.Cache(cache_dir, max_size)
+        self.urls_dir = os.path.join(cache_dir, '.urls')
+        os.makedirs(self.urls_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.stats = {'hit': [0, 0], 'miss': [0, 0], 'pass': [0, 0]}
+        self.archives = set()  # host[:port] of allowed upstream servers
+        self.servers = {}  # listening address -> ProxyServer
+        self.pid = os.getpid()
+        self.port = self.listen('127.0.0.1')
+        adtlog.debug('package proxy: listening on port %i, cache %s' %
+                     (self.port, cache_dir))
+
+    def listen(self, address):
+        '''Also accept connections on given host address
+
+        Return the port, or None if address is not an IPv4 address of a
+        local network interface. In a forked child process (like --parallel
+        workers) this only returns the ports of addresses which the original
+        process already listens on, as the serving threads run there.
+        '''
+        if address in self.servers:
+            return self.servers[address].server_address[1]
+        if os.getpid() != self.pid:
+            return None
+        try:
+            if ipaddress.ip_address(address) in loopback:
+                network = loopback
+            else:
+                network = local_network(address)
+        except ValueError:
+            network = None
+        if not network:
+            adtlog.debug('package proxy: %s is not on a local network' %
+                         address)
+            return None
+        try:
+            server = ProxyServer((address, 0), ProxyRequestHandler)
+        except OSError as e:
+            adtlog.debug('package proxy: cannot listen on %s: %s' %
+                         (address, e))
+            return None
+        server.proxy = self
+        server.network = network
+        self.servers[address] = server
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        adtlog.debug('package proxy: listening on %s:%i for clients from %s' %
+                     (address, server.server_address[1], network))
+        return server.server_address[1]
+
+    def add_archives(self, hosts):
+        '''Allow forwarding requests to given host[:port] archive servers'''
+
+        with self.lock:
+            self.archives.update([h.lower() for h in hosts])
+
+    def stop(self):
+        '''Shut down the proxy and log statistics'''
+
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        adtlog.info('package proxy: %i hits (%s), %i misses (%s), '
+                    '%i uncached requests (%s)' % (
+                        self.stats['hit'][0],
+                        format_size(self.stats['hit'][1]),
+                        self.stats['miss'][0],
+                        format_size(self.stats['miss'][1]),
+                        self.stats['pass'][0],
+                        format_size(self.stats['pass'][1])))
+
+    def count(self, kind, size):
+        with self.lock:
+            self.stats[kind][0] += 1
+            self.stats[kind][1] += size
+
+    def handle(self, req, body):
+        if req.path == probe_url:
+            req.send_response(200, 'autopkgtest-proxy')
+            req.end_headers()
+            return
+        url = urllib.parse.urlsplit(req.path)
+        if url.scheme != 'http':
+            req.send_error(400, 'only proxying http:// URLs')
+            return
+        if url.netloc.lower() not in self.archives:
+            req.send_error(403, 'only proxying apt archives of the testbed')
+            return
+
+        if cacheable_re.search(req.path) and 'Range' not in req.headers:
+            url_file = os.path.join(
+                self.urls_dir, hashlib.sha256(req.path.encode()).hexdigest())
+            try:
+                with open(url_file) as f:
+                    entry = self.cache.lookup(f.read())
+            except IOError:
+                entry = None
+            if entry:
+                self.serve_file(req, os.path.join(entry, 'data'), body)
+                return
+            self.fetch(req, body, url_file)
+        else:
+            self.fetch(req, body, None)
+
+    def serve_file(self, req, path, body):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            # evicted in the meantime
+            req.send_error(503, 'cache entry disappeared')
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            req.send_response(200)
+            req.send_header('Content-Type', 'application/octet-stream')
+            req.send_header('Content-Length', str(size))
+            req.end_headers()
+            if body:
+                shutil.copyfileobj(f, req.wfile, 1048576)
+        self.count('hit', size)
+
+    def fetch(self, req, body, url_file):
+        '''Forward request upstream and relay the response
+
+        If url_file is given, a successful response gets stored in the cache.
+        '''
+        headers = dict([(k, v) for (k, v) in req.headers.items()
+                        if k.lower() not in hop_by_hop])
+        upstream = urllib.request.Request(req.path, headers=headers,
+                                          method=req.command)
+        try:
+            resp = urllib.request.urlopen(upstream, timeout=60)
+        except urllib.error.HTTPError as e:
+            resp = e
+        except (urllib.error.URLError, OSError) as e:
+            req.send_error(502, str(e))
+            return
+
+        with resp:
+            req.send_response(resp.getcode())
+            for (k, v) in resp.headers.items():
+                if k.lower() not in hop_by_hop:
+                    req.send_header(k, v)
+            req.end_headers()
+            if not body:
+                return
+
+            store = url_file and resp.getcode() == 200
+            if store:
+                tmp = tempfile.NamedTemporaryFile(dir=self.cache.path,
+                                                  prefix='.download-',
+                                                  delete=False)
+                h = hashlib.sha256()
+            size = 0
+            try:
+                while True:
+                    block = resp.read(1048576)
+                    if not block:
+                        break
+                    req.wfile.write(block)
+                    size += len(block)
+                    if store:
+                        tmp.write(block)
+                        h.update(block)
+                length = resp.headers.get('Content-Length')
+                if store and (length is None or int(length) == size):
+                    tmp.close()
+                    self.store(url_file, tmp.name, h.hexdigest(), size)
+            finally:
+                if store:
+                    tmp.close()
+                    if os.path.exists(tmp.name):
+                        os.unlink(tmp.name)
+        self.count(store and 'miss' or 'pass', size)
+
+    def store(self, url_file, path, content_hash, size):
+        if not self.cache.lookup(content_hash):
+            entry = self.cache.new_entry()
+            os.rename(path, os.path.join(entry, 'data'))
+            self.cache.commit(content_hash, entry, size)
+        new = '%s.%i' % (url_file, threading.get_ident())
+        with open(new, 'w') as f:
+            f.write(content_hash)
+        os.rename(new, url_file)
+
+
+def local_network(address, route_file='/proc/net/route'):
+    '''Return the directly connected network of a local IPv4 address
+
+    This is determined from the routing table; return None if there is no
+    such route.
+    '''
+    address = ipaddress.IPv4Address(address)
+    best = None
+    with open(route_file) as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            # fields are in network byte order, printed as native integers
+            (dest, gateway, mask) = [
+                struct.unpack('!I', struct.pack('=I', int(fields[i], 16)))[0]
+                for i in (1, 2, 7)]
+            # routes through a gateway and the default route are not local
+            if gateway or not mask:
+                continue
+            network = ipaddress.IPv4Network((dest, bin(mask).count('1')))
+            if address in network and (
+                    best is None or network.prefixlen > best.prefixlen):
+                best = network
+    return best
+
+
+def format_size(size):
+    for unit in ['B', 'kB', 'MB']:
+        if size < 1024:
+            return '%i %s' % (size, unit)
+        size /= 1024
+    return '%.1f GB' % size
@@ -0,0 +1,263 @@
+# adt_results is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+'''Machine readable test results with timing of adt-run's phases
+
+Results collects a record for every action (source package, tree, click)
+and every test in it. Each record has the wall clock time spent in each
+phase (like "open", "dependencies", "build", "test"), the number of testbed
+commands, and the number of bytes copied to and from the testbed. Phases can
+nest; time is only attributed to the innermost one, so that the phases of a
+record add up to (at most) its duration. Work outside of any action, like
+opening the testbed, gets recorded in the "testbed" record.
+'''
+
+import os
+import json
+import time
+import contextlib
+import xml.etree.ElementTree as ET
+
+# appended to the result of tests which were not run, but taken from the
+# --result-cache
+cached_marker = ' (cached)'
+
+
+def new_record(**fields):
+    record = {'phases': {}, 'commands': 0, 'bytes_down': 0, 'bytes_up': 0}
+    record.update(fields)
+    return record
+
+
+def path_size(path):
+    '''Return size of a file, or the total size of files in a directory'''
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        try:
+            return os.lstat(path).st_size
+        except OSError:
+            return 0
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class Results:
+    def __init__(self, command_line=None):
+        self.start = time.time()
+        self.command_line = command_line
+        self.testbed = new_record()
+        self.actions = []
+        self.action = None
+        self.test = None
+        # [phase name, start of not yet attributed time] of active phases
+        self.phases = []
+
+    def record(self):
+        '''Return the record which currently gets charged'''
+
+        return self.test or self.action or self.testbed
+
+    def _charge(self, now):
+        if self.phases:
+            (name, since) = self.phases[-1]
+            p = self.record()['phases']
+            p[name] = p.get(name, 0) + now - since
+            self.phases[-1][1] = now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Context manager for attributing time to phase name'''
+
+        now = time.time()
+        self._charge(now)
+        entry = [name, now]
+        self.phases.append(entry)
+        try:
+            yield
+        finally:
+            now = time.time()
+            if self.phases[-1] is entry:
+                self._charge(now)
+                self.phases.pop()
+                if self.phases:
+                    self.phases[-1][1] = now
+            else:
+                # overlapping phases of concurrent coroutines
+                self.phases.remove(entry)
+
+    def count_commands(self, n=1):
+        self.record()['commands'] += n
+
+    def count_bytes(self, direction, size):
+        '''Count size bytes copied "down" to or "up" from the testbed'''
+
+        self.record()['bytes_' + direction] += size
+
+    def begin_action(self, kind, arg):
+        self._charge(time.time())
+        self.action = new_record(kind=kind, arg=arg, start=time.time(),
+                                 tests=[])
+        self.actions.append(self.action)
+
+    def end_action(self):
+        if self.action:
+            self._charge(time.time())
+            self.action['duration'] = time.time() - self.action['start']
+            self.action = None
+
+    def begin_test(self, name):
+        self._charge(time.time())
+        self.test = new_record(name=name, start=time.time(), result=None,
+                               reason=None, cached=False)
+        self.add_test(self.test)
+
+    def end_test(self):
+        '''Finish the current test and return its record'''
+
+        test = self.test
+        if test:
+            self._charge(time.time())
+            test['duration'] = time.time() - test['start']
+            self.test = None
+        return test
+
+    def add_test(self, test):
+        '''Add a test record to the current action'''
+
+        if self.action is None:
+            self.begin_action(None, None)
+        self.action['tests'].append(test)
+
+    def take_tests(self):
+        '''Remove the test records of the current action and return them
+
+        This is used for passing the results of --parallel workers to the
+        main process, which add_test()s them.
+        '''
+        if self.action is None:
+            return []
+        tests = self.action['tests']
+        self.action['tests'] = []
+        return tests
+
+    def set_package(self, name, version):
+        if self.action is not None:
+            self.action['package'] = name
+            self.action['version'] = version
+
+    def report(self, tname, result):
+        '''Record a test result as passed to adtlog.report()'''
+
+        cached = result.endswith(cached_marker)
+        if cached:
+            result = result[:-len(cached_marker)]
+        (result, reason) = (result.split(None, 1) + [None])[:2]
+        if self.test and self.test['name'] == tname:
+            test = self.test
+        else:
+            test = new_record(name=tname, start=time.time(), duration=0)
+            self.add_test(test)
+        test['result'] = result
+        test['reason'] = reason
+        test['cached'] = cached
+
+    def as_dict(self, exit_code=None):
+        totals = new_record(tests=0, passed=0, failed=0, skipped=0, cached=0)
+
+        def add(record):
+            for (name, secs) in record['phases'].items():
+                totals['phases'][name] = totals['phases'].get(name, 0) + secs
+            for f in ('commands', 'bytes_down', 'bytes_up'):
+                totals[f] += record[f]
+
+        add(self.testbed)
+        for action in self.actions:
+            add(action)
+            for test in action['tests']:
+                add(test)
+                totals['tests'] += 1
+                if test.get('cached'):
+                    totals['cached'] += 1
+                if test['result'] == 'PASS':
+                    totals['passed'] += 1
+                elif test['result'] == 'SKIP':
+                    totals['skipped'] += 1
+                else:
+                    totals['failed'] += 1
+
+        return {'command_line': self.command_line,
+                'start': self.start,
+                'duration': time.time() - self.start,
+                'exit_code': exit_code,
+                'testbed': self.testbed,
+                'actions': self.actions,
+                'totals': totals}
+
+    def write_json(self, path, exit_code=None):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(exit_code), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def write_junit(self, path):
+        '''Write results in JUnit XML format
+
+        Every action becomes a <testsuite>, its phase timings are added as
+        <properties>.
+        '''
+        suites = ET.Element('testsuites')
+        for action in self.actions:
+            tests = action['tests']
+            suite = ET.SubElement(suites, 'testsuite', {
+                'name': action.get('package') or action['arg'] or '',
+                'tests': str(len(tests)),
+                'failures': str(len([t for t in tests if t['result'] not in
+                                     ('PASS', 'SKIP')])),
+                'skipped': str(len([t for t in tests
+                                    if t['result'] == 'SKIP'])),
+                'time': '%.3f' % action.get('duration', 0)})
+            props = ET.SubElement(suite, 'properties')
+            for (name, secs) in sorted(action['phases'].items()):
+                ET.SubElement(props, 'property', {'name': 'phase.' + name,
+                                                  'value': '%.3f' % secs})
+            for test in tests:
+                case = ET.SubElement(suite, 'testcase', {
+                    'classname': suite.get('name'),
+                    'name': test['name'],
+                    'time': '%.3f' % test.get('duration', 0)})
+                if test.get('cached'):
+                    props = ET.SubElement(case, 'properties')
+                    ET.SubElement(props, 'property', {'name': 'cached',
+                                                      'value': 'true'})
+                if test['result'] == 'SKIP':
+                    ET.SubElement(case, 'skipped',
+                                  {'message': test['reason'] or ''})
+                elif test['result'] != 'PASS':
+                    ET.SubElement(case, 'failure',
+                                  {'message': test['reason'] or 'no result'})
+        ET.ElementTree(suites).write(path, encoding='UTF-8',
+                                     xml_declaration=True)
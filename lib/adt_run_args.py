@@ -163,17 +163,9 @@ class BinariesArg(argparse.Action):
                                       option_string)
 
 
-def parse_args(arglist=None):
-    '''Parse adt-run command line arguments.
-
-    Return (options, actions, virt-server-args).
-    '''
-    global actions, built_binaries
+def _action_parser():
+    '''Return the parser for the adt-run actions'''
 
-    actions = []
-    built_binaries = True
-
-    # action parser; instantiated first to use generated help
     action_parser = argparse.ArgumentParser(usage=argparse.SUPPRESS,
                                             add_help=False)
     action_parser.add_argument(
@@ -217,6 +209,21 @@ def parse_args(arglist=None):
     action_parser.add_argument(
         '--built-binaries', nargs=0, action=BinariesArg,
         help='use binaries from subsequent --source or --unbuilt-tree actions')
+    return action_parser
+
+
+def parse_args(arglist=None):
+    '''Parse adt-run command line arguments.
+
+    Return (options, actions, virt-server-args).
+    '''
+    global actions, built_binaries
+
+    actions = []
+    built_binaries = True
+
+    # action parser; instantiated first to use generated help
+    action_parser = _action_parser()
 
     # main / options parser
     usage = '%(prog)s [options] action [action ...] --- virt-server [options]'
@@ -243,9 +250,18 @@ details.'''
     g_log.add_argument('-l', '--log-file', dest='logfile',
                        help='Write the log LOGFILE, emptying it beforehand,'
                        ' instead of using OUTPUT-DIR/log')
+    g_log.add_argument('--log-compress', action='store_true',
+                       help='Write the log gzip compressed (to '
+                       'OUTPUT-DIR/log.gz without --log-file)')
     g_log.add_argument('--summary-file', dest='summary',
                        help='Write a summary report to SUMMARY, emptying it '
                        'beforehand')
+    g_log.add_argument('--test-output-compress', action='store_true',
+                       help='Write gzip compressed test stdout/stderr files '
+                       '(TEST-stdout.gz, TEST-stderr.gz)')
+    g_log.add_argument('--test-output-max-size', metavar='MB', type=int,
+                       help='Only keep the first MB MiB of each test\'s '
+                       'stdout and stderr in the files in OUTPUT-DIR')
     g_log.add_argument('-q', '--quiet', action='store_const', dest='verbosity',
                        const=0, default=1,
                        help='Suppress all messages from %(prog)s itself '
@@ -273,9 +289,65 @@ details.'''
                          action='append', default=[],
                          help='Copy file or dir from host into testbed after '
                          'opening')
+    g_setup.add_argument('--tree-exclude', metavar='PATTERN',
+                         action='append', default=[],
+                         help='Do not copy files or directories matching the '
+                         'shell PATTERN (like .git or .pc) of --unbuilt-tree '
+                         'and --built-tree trees into the testbed; can be '
+                         'given multiple times')
     g_setup.add_argument('--env', metavar='VAR=value',
                          action='append', default=[],
                          help='Set arbitrary environment variable for a test')
+    g_setup.add_argument('--parallel', metavar='N', type=int, default=1,
+                         help='Run the tests of a package on a pool of N '
+                         'testbeds in parallel (needs a testbed which '
+                         'supports reverting)')
+    g_setup.add_argument('--no-reorder-tests', dest='reorder_tests',
+                         action='store_false', default=True,
+                         help='Always run tests in the order of the test '
+                         'control file, even if grouping them by dependencies '
+                         'would save testbed reverts')
+    g_setup.add_argument('--state-cache', metavar='DIR',
+                         help='Keep snapshots of the testbed after installing '
+                         'test dependencies in DIR, and reuse them instead of '
+                         'installing the same dependencies again (needs a '
+                         'virt server with the state-cache capability)')
+    g_setup.add_argument('--state-cache-size', metavar='MB', type=int,
+                         default=10240,
+                         help='Remove least recently used snapshots when the '
+                         '--state-cache grows beyond MB MiB (default: '
+                         '%(default)s)')
+    g_setup.add_argument('--apt-proxy-cache', metavar='DIR',
+                         help='Run a caching HTTP proxy for apt which keeps '
+                         'downloaded packages in DIR, and use it for '
+                         'installing packages in the testbed')
+    g_setup.add_argument('--apt-proxy-cache-size', metavar='MB', type=int,
+                         default=10240,
+                         help='Remove least recently used packages when the '
+                         '--apt-proxy-cache grows beyond MB MiB (default: '
+                         '%(default)s)')
+    g_setup.add_argument('--build-cache', metavar='DIR',
+                         help='Keep built source packages and their binaries '
+                         'in DIR, and reuse them instead of building the same '
+                         'source again on the same testbed')
+    g_setup.add_argument('--build-cache-size', metavar='MB', type=int,
+                         default=10240,
+                         help='Remove least recently used builds when the '
+                         '--build-cache grows beyond MB MiB (default: '
+                         '%(default)s)')
+    g_setup.add_argument('--result-cache', metavar='DIR',
+                         help='Keep test results in DIR, and report the '
+                         'cached result instead of running a test again if '
+                         'the tests tree, the test dependencies, and the '
+                         'versions of all installed packages are unchanged')
+    g_setup.add_argument('--result-cache-size', metavar='MB', type=int,
+                         default=1024,
+                         help='Remove least recently used results when the '
+                         '--result-cache grows beyond MB MiB (default: '
+                         '%(default)s)')
+    g_setup.add_argument('--result-cache-max-age', metavar='DAYS', type=float,
+                         help='Run tests again if their cached result is '
+                         'older than DAYS days (default: no limit)')
 
     # privileges
     g_priv = parser.add_argument_group('user/privilege handling options')
@@ -295,6 +367,10 @@ details.'''
                        'build or test')
     g_dbg.add_argument('--shell', action='store_true',
                        help='Run a shell in the testbed after every test')
+    g_dbg.add_argument('--trace', metavar='FILE',
+                       help='Write timings of all testbed commands, copies, '
+                       'and virt server operations to FILE, in Chrome trace '
+                       'event format')
 
     # timeouts
     g_time = parser.add_argument_group('timeout options')
@@ -322,6 +398,17 @@ details.'''
         '--no-auto-control', dest='auto_control', action='store_false',
         default=True,
         help='Disable automatic test generation with autodep8')
+    g_misc.add_argument(
+        '--virt-in-process', action='store_true',
+        help='Load the virtualization server as a Python module into the '
+        'adt-run process and call its operations directly, instead of '
+        'talking to it through pipes')
+    g_misc.add_argument(
+        '--worker', metavar='SPOOLDIR',
+        help='Keep the testbed open and run the jobs from SPOOLDIR/*.job '
+        '(files with action arguments, one per line) one after another, '
+        'reverting the testbed in between; write their output to '
+        'SPOOLDIR/results/JOB/')
     g_misc.add_argument(
         '-h', '--help', action='help', default=argparse.SUPPRESS,
         help='show this help message and exit')
@@ -361,6 +448,13 @@ details.'''
         if '=' not in e:
             parser.error('--env must be KEY=value')
 
+    # verify --parallel validity
+    if args.parallel < 1:
+        parser.error('--parallel must be at least 1')
+    if args.parallel > 1 and (args.shell or args.shell_fail):
+        parser.error('--shell and --shell-fail cannot be used with '
+                     '--parallel')
+
     # set (possibly adjusted) timeout defaults
     for k in timeouts:
         if getattr(args, 'timeout_' + k) is None:
@@ -370,7 +464,20 @@ details.'''
     # this timeout is for adt-virt-*, so pass it down via environment
     os.environ['ADT_VIRT_COPY_TIMEOUT'] = str(args.timeout_copy)
 
-    if not actions:
+    # the state cache is managed by adt-virt-*, so pass it down as well
+    if args.state_cache:
+        os.environ['ADT_VIRT_STATE_CACHE'] = os.path.abspath(args.state_cache)
+        os.environ['ADT_VIRT_STATE_CACHE_SIZE'] = str(args.state_cache_size)
+
+    if args.worker:
+        if actions:
+            parser.error('--worker takes the actions from the job files in '
+                         'SPOOLDIR')
+        if args.output_dir or args.logfile or args.summary:
+            parser.error('--worker writes the output of each job to '
+                         'SPOOLDIR/results/, it cannot be used with '
+                         '--output-dir, --log-file, or --summary-file')
+    elif not actions:
         parser.error('You must specify at least one action')
 
     # if we have --setup-commands and it points to a file, read its contents
@@ -398,3 +505,24 @@ details.'''
     args.copy = copy_pairs
 
     return (args, actions, virt_args)
+
+
+def parse_job_args(path):
+    '''Parse the actions of a --worker job file
+
+    The file has one argument per line, like the @ argument files. Return the
+    list of actions; exit with an error message for invalid arguments.
+    '''
+    global actions, built_binaries
+
+    actions = []
+    built_binaries = True
+    with open(path, encoding='UTF-8') as f:
+        arglist = [l.strip() for l in f if l.strip()]
+
+    parser = _action_parser()
+    parser.prog = os.path.basename(path)
+    parser.parse_args(interpret_implicit_args(parser, arglist))
+    if not actions:
+        parser.error('You must specify at least one action')
+    return actions
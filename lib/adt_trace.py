@@ -0,0 +1,123 @@
+# adt_trace is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# autopkgtest is Copyright (C) 2006-2015 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+'''Tracing of testbed operations in Chrome trace event format
+
+adt-run --trace and the virt servers which it starts record spans (testbed
+commands, copies, virt server hooks) as JSON lines into a spool file, whose
+path is passed to the virt servers in $ADT_TRACE_SPOOL. Appending each event
+with a single write() keeps events from different processes (virt servers,
+--parallel workers) intact. At the end, adt-run converts the spool into a
+JSON array of trace events for chrome://tracing or Perfetto.
+'''
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+spool_env = 'ADT_TRACE_SPOOL'
+
+# file descriptor of the spool file, None if tracing is disabled
+spool_fd = None
+
+
+def enable(path):
+    '''Start recording spans into given spool file'''
+
+    global spool_fd
+    spool_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+def enable_from_env():
+    '''Enable tracing if $ADT_TRACE_SPOOL is set (in virt servers)'''
+
+    path = os.environ.get(spool_env)
+    if path:
+        enable(path)
+
+
+def enabled():
+    return spool_fd is not None
+
+
+def _write(event):
+    os.write(spool_fd, (json.dumps(event, default=str) + '\n').encode('UTF-8'))
+
+
+def record(name, cat, start, **args):
+    '''Record a span from start (a time.time() value) until now'''
+
+    if spool_fd is not None:
+        _write({'name': name, 'cat': cat, 'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((time.time() - start) * 1000000),
+                'pid': os.getpid(), 'tid': threading.get_ident() % 1000000,
+                'args': args})
+
+
+@contextlib.contextmanager
+def span(name, cat, **args):
+    '''Record the run time of the with block as span
+
+    The yielded args dict can be updated in the block to add more details
+    like exit codes or byte counts to the span.
+    '''
+    if spool_fd is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args.setdefault('error', '%s: %s' % (e.__class__.__name__, e))
+        raise
+    finally:
+        record(name, cat, start, **args)
+
+
+def process_name(name):
+    '''Label the current process in the trace'''
+
+    if spool_fd is not None:
+        _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                'args': {'name': name}})
+
+
+def write_trace(spool, path):
+    '''Convert spool file into a Chrome trace event file'''
+
+    with open(spool, 'rb') as s, open(path, 'w') as f:
+        f.write('[\n')
+        first = True
+        for line in s:
+            try:
+                event = json.loads(line.decode('UTF-8'))
+            except ValueError:
+                # truncated by a killed process
+                continue
+            if not first:
+                f.write(',\n')
+            json.dump(event, f)
+            first = False
+        f.write('\n]\n')
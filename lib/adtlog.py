@@ -22,74 +22,292 @@
 
 import sys
 import time
-import errno
 import os
+import gzip
+import json
+import atexit
+import collections
+import select
+import threading
 
 summary_stream = None
 verbosity = 1  # 0: quiet (warning/error only), 1: info, 2: debug
 enable_colors = None
+# [[test name, result or None], ...] while report() holds back lines
+held_reports = None
+# called with (test name, result) for every report(), e. g. for recording
+# machine readable results
+report_handler = None
+# LogCapture of stdout/stderr, see capture_output()
+log_capture = None
 
 
-def log(message, level, prefix='', timestamp=False, color=None):
-    '''Write a log message to stderr'''
+class Record:
+    '''A log message
 
-    if level > verbosity:
-        return
+    The message only gets %-formatted with args when a sink needs its text.
+    '''
+    __slots__ = ('message', 'args', 'level', 'prefix', 'timestamp', 'color',
+                 'time')
+
+    def __init__(self, message, args, level, prefix, timestamp, color):
+        self.message = message
+        self.args = args
+        self.level = level
+        self.prefix = prefix
+        self.timestamp = timestamp
+        self.color = color
+        self.time = time.time()
+
+    def text(self):
+        if self.args:
+            return self.message % self.args
+        return self.message
+
+    def as_dict(self):
+        return {'time': self.time, 'level': self.level,
+                'prefix': self.prefix, 'message': self.text()}
+
+
+class TextSink:
+    '''Write records as human readable lines to a stream (default: stderr)
+
+    level is the maximum level of records to write; None follows verbosity.
+    By default every line gets written right away, so that it stays in order
+    with the output of subprocesses (like virt servers) which write to the
+    same stream. With a flush_interval, lines get buffered; the buffer gets
+    written out when a record with at most flush_level arrives,
+    flush_interval seconds after the first buffered line, and on flush().
+    '''
+
+    def __init__(self, stream=None, level=None, flush_level=1,
+                 flush_interval=None):
+        self.stream = stream
+        self.level = level
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buf = []
+        self.timer = None
+
+    def emit(self, record):
+        if record.level > (verbosity if self.level is None else self.level):
+            return
+        # needs lazy initialization as adt-run may redirect stderr
+        global enable_colors
+        if enable_colors is None:
+            try:
+                enable_colors = os.isatty(self._stream().fileno())
+            except (AttributeError, OSError, ValueError):
+                enable_colors = False
+        line = format_record(record, enable_colors)
+        with self.lock:
+            self.buf.append(line)
+            if self.flush_interval is None or record.level <= self.flush_level:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _stream(self):
+        return self.stream or sys.stderr
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buf:
+            return
+        data = b''.join(self.buf)
+        self.buf = []
+        stream = self._stream()
+        stream.flush()
+        out = getattr(stream, 'buffer', stream)
+        out.flush()
+        try:
+            fd = out.fileno()
+        except (AttributeError, OSError, ValueError):
+            out.write(data)
+            out.flush()
+            return
+        # stderr might be non-blocking
+        while data:
+            try:
+                data = data[os.write(fd, data):]
+            except BlockingIOError:
+                select.select([], [fd], [])
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.timer = None
+        self.buf = []
+
+
+class JSONSink:
+    '''Write records as JSON lines into a file'''
+
+    def __init__(self, path, level=2):
+        self.level = level
+        self.f = open(path, 'w', buffering=1048576)
+
+    def emit(self, record):
+        if record.level <= self.level:
+            self.f.write(json.dumps(record.as_dict()) + '\n')
+            if record.level == 0:
+                self.f.flush()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class RingSink:
+    '''Keep the last size records in memory
 
-    # needs lazy initialization as adt-run may redirect it to tee
-    global enable_colors
-    if enable_colors is None:
-        enable_colors = os.isatty(sys.stderr.fileno())
+    This is cheap as the records do not get formatted until dump(), e. g.
+    for showing the debug messages which led up to a crash.
+    '''
 
-    head = sys.argv[0].split('/')[-1]
-    if timestamp:
-        head += ' [%s]: ' % time.strftime('%H:%M:%S')
+    def __init__(self, size=1000, level=2):
+        self.level = level
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        if record.level <= self.level:
+            self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def dump(self, stream):
+        '''Write the kept records as text lines to a binary stream'''
+
+        for record in self.records:
+            stream.write(format_record(record))
+        stream.flush()
+
+
+# program name at the start of each log line
+prog = os.path.basename(sys.argv[0])
+# sinks which get all log records; see add_sink()
+sinks = [TextSink()]
+# maximum level of records which any sink wants, in addition to verbosity
+_sink_level = -1
+# (second, formatted time) of the last timestamp
+_timestamp_cache = (None, None)
+
+
+def format_record(record, color=False):
+    '''Return record as UTF-8 encoded text line'''
+
+    global _timestamp_cache
+
+    head = prog
+    if record.timestamp:
+        secs = int(record.time)
+        if _timestamp_cache[0] != secs:
+            _timestamp_cache = (secs, time.strftime('%H:%M:%S',
+                                                    time.localtime(secs)))
+        head += ' [%s]: ' % _timestamp_cache[1]
     else:
         head += ': '
 
-    if prefix:
-        head += prefix + ': '
+    if record.prefix:
+        head += record.prefix + ': '
 
-    out = (head + message + '\n').encode('UTF-8')
+    out = (head + record.text() + '\n').encode('UTF-8')
 
-    if color is not None and enable_colors:
-        out = b'\033[3' + chr(47 + color).encode() + b'm' + out + b'\033[0m'
+    if record.color is not None and color:
+        out = (b'\033[3' + chr(47 + record.color).encode() + b'm' + out +
+               b'\033[0m')
+    return out
 
-    # we sometimes hit EAGAIN here, try a few times
-    retries = 10
-    while retries >= 0:
-        try:
-            sys.stderr.buffer.write(out)
-            break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                retries -= 1
-                time.sleep(0.05)
-            else:
-                raise
-    sys.stderr.buffer.flush()
 
+def _update_sink_level():
+    global _sink_level
+    _sink_level = max([s.level for s in sinks if s.level is not None] + [-1])
 
-def error(message):
-    log(message, 0, prefix='ERROR', timestamp=True, color=2)
 
+def add_sink(sink):
+    '''Send log records to sink as well
+
+    A sink has a "level" attribute with the maximum level of records it
+    wants (None to follow verbosity), and emit(record) and flush() methods.
+    '''
+    sinks.append(sink)
+    _update_sink_level()
+
+
+def remove_sink(sink):
+    sink.flush()
+    sinks.remove(sink)
+    _update_sink_level()
+
+
+def enabled(level):
+    '''Check if any sink wants records of given level
+
+    Use this to avoid expensive computations for log arguments.
+    '''
+    return level <= verbosity or level <= _sink_level
+
+
+def log(message, level, prefix='', timestamp=False, color=None, args=()):
+    '''Send a log message to the sinks (by default, stderr)
+
+    If args are given, the message gets %-formatted with them only if a sink
+    actually uses the message.
+    '''
+    if level > verbosity and level > _sink_level:
+        return
+
+    record = Record(message, args, level, prefix, timestamp, color)
+    for sink in sinks:
+        sink.emit(record)
 
-def warning(message):
-    log(message, 0, prefix='WARNING', color=5)
 
+def error(message, *args):
+    log(message, 0, prefix='ERROR', timestamp=True, color=2, args=args)
 
-def info(message):
-    log(message, 1, timestamp=True, color=4)
 
+def warning(message, *args):
+    log(message, 0, prefix='WARNING', color=5, args=args)
 
-def debug(message):
-    log(message, 2, prefix='DBG', timestamp=False, color=8)
+
+def info(message, *args):
+    log(message, 1, timestamp=True, color=4, args=args)
+
+
+def debug(message, *args):
+    log(message, 2, prefix='DBG', timestamp=False, color=8, args=args)
+
+
+def flush_sinks():
+    for sink in sinks:
+        sink.flush()
+
+
+def _after_fork():
+    for sink in sinks:
+        if isinstance(sink, TextSink):
+            sink.after_fork()
+
+
+atexit.register(flush_sinks)
+os.register_at_fork(before=flush_sinks, after_in_child=_after_fork)
 
 
 def debug_subprocess(what, argv, script=None):
     '''Log a subprocess call for debugging'''
 
-    if verbosity < 2:
+    if not enabled(2):
         return
 
     o = '$ ' + what + ':'
@@ -115,11 +333,223 @@ def psummary(m):
 
 
 def preport(m):
+    # keep the order with log messages on stderr
+    flush()
     sys.stdout.buffer.write(m.encode('UTF-8'))
     sys.stdout.buffer.write(b'\n')
-    sys.stdout.buffer.flush()
+    flush()
     psummary(m)
 
 
 def report(tname, result):
+    if report_handler is not None:
+        report_handler(tname, result)
+    _report(tname, result)
+
+
+def _report(tname, result):
+    if held_reports is not None:
+        for entry in held_reports:
+            if entry[0] == tname and entry[1] is None:
+                entry[1] = result
+                break
+        else:
+            preport('%-20s %s' % (tname, result))
+        while held_reports and held_reports[0][1] is not None:
+            (tname, result) = held_reports.pop(0)
+            preport('%-20s %s' % (tname, result))
+        return
     preport('%-20s %s' % (tname, result))
+
+
+def hold_reports(tnames):
+    '''Write report() lines for given tests in the order of tnames
+
+    A test's result is held back until all tests before it got reported.
+    '''
+    global held_reports
+    held_reports = [[n, None] for n in tnames]
+
+
+def release_reports():
+    '''Write all held back report() lines and stop holding them'''
+
+    global held_reports
+    pending = held_reports
+    held_reports = None
+    for (tname, result) in pending or []:
+        if result is not None:
+            _report(tname, result)
+
+
+class LogCapture:
+    '''Copy everything written to stdout and stderr into a log file
+
+    This redirects fds 1 and 2 (and thus the output of child processes too)
+    to pipes, which a thread copies to the original stdout/stderr and to the
+    log file (gzip compressed if compress is True). Use barrier() to wait
+    until everything which has been written so far got copied.
+    '''
+
+    def __init__(self, path, compress=False):
+        if compress:
+            self.log = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            self.log = open(path, 'wb', buffering=1048576)
+        self.pid = os.getpid()
+        # pipe read end -> copy of the original fd
+        self.terminal = {}
+        # [(redirected fd, pipe read end)]
+        self.redirected = []
+        flush_sinks()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd in (sys.stdout.fileno(), sys.stderr.fileno()):
+            (r, w) = os.pipe()
+            os.set_blocking(r, False)
+            self.terminal[r] = os.dup(fd)
+            self.redirected.append((fd, r))
+            os.dup2(w, fd)
+            os.close(w)
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.cond = threading.Condition()
+        self.requested = 0
+        self.done = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name='log capture',
+                                       daemon=True)
+        self.thread.start()
+
+    def _write(self, fd, data):
+        while data:
+            try:
+                data = data[os.write(fd, data):]
+            except BlockingIOError:
+                select.select([], [fd], [])
+
+    def _copy(self, fd):
+        '''Copy available data from pipe fd
+
+        Return False on EOF, None if there is nothing to read.
+        '''
+        try:
+            data = os.read(fd, 1048576)
+        except BlockingIOError:
+            return None
+        if data:
+            self._write(self.terminal[fd], data)
+            self.log.write(data)
+            return True
+        return False
+
+    def _drain(self, fds):
+        for fd in list(fds):
+            while True:
+                r = self._copy(fd)
+                if r is None:
+                    break
+                if r is False:
+                    fds.remove(fd)
+                    break
+
+    def _run(self):
+        fds = list(self.terminal)
+        try:
+            while fds:
+                # flush the log when output pauses
+                ready = select.select(fds + [self.wake_r], [], [], 1)[0]
+                if not ready:
+                    self.log.flush()
+                    continue
+                for fd in ready:
+                    if fd != self.wake_r and self._copy(fd) is False:
+                        fds.remove(fd)
+                if self.wake_r in ready:
+                    os.read(self.wake_r, 4096)
+                    with self.cond:
+                        target = self.requested
+                    self._drain(fds)
+                    self.log.flush()
+                    with self.cond:
+                        self.done = target
+                        self.cond.notify_all()
+                        if self.stopping:
+                            break
+        finally:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+
+    def barrier(self, timeout=None):
+        '''Wait until previous output got written to terminal and log
+
+        This does nothing in forked child processes, which do not have the
+        copying thread.
+        '''
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.getpid() != self.pid:
+            return
+        with self.cond:
+            if self.stopping:
+                return
+            self.requested += 1
+            target = self.requested
+        os.write(self.wake_w, b'x')
+        with self.cond:
+            self.cond.wait_for(lambda: self.done >= target or self.stopping,
+                               timeout)
+
+    def close(self):
+        '''Copy remaining output, restore stdout/stderr, and close the log'''
+
+        if os.getpid() != self.pid:
+            return
+        flush_sinks()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for (fd, r) in self.redirected:
+            os.dup2(self.terminal[r], fd)
+        with self.cond:
+            self.stopping = True
+        os.write(self.wake_w, b'x')
+        self.thread.join()
+        for (fd, r) in self.redirected:
+            os.close(self.terminal[r])
+            os.close(r)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        self.log.close()
+
+
+def capture_output(path, compress=False):
+    '''Start copying stdout and stderr into log file path'''
+
+    global log_capture, enable_colors
+    log_capture = LogCapture(path, compress)
+    enable_colors = False
+
+
+def stop_capture():
+    '''Stop copying stdout and stderr into the log file'''
+
+    global log_capture, enable_colors
+    if log_capture is not None:
+        log_capture.close()
+        log_capture = None
+        enable_colors = None
+
+
+def flush():
+    '''Flush stdout and stderr
+
+    When capturing output into a log, wait until everything which was
+    written so far got copied, so that output from different streams and
+    processes is not mis-ordered.
+    '''
+    flush_sinks()
+    if log_capture is not None:
+        log_capture.barrier()
+    else:
+        sys.stdout.flush()
+        sys.stderr.flush()
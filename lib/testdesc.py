@@ -29,6 +29,7 @@ import subprocess
 import tempfile
 import atexit
 import shutil
+import functools
 
 import debian.deb822
 import debian.debian_support
@@ -161,6 +162,114 @@ class Test:
                               'Test needs root on testbed which is not '
                               'available')
 
+#
+# Test scheduling
+#
+
+
+def _needs_revert(deps_installed, recommends_installed, modified, test):
+    '''Check if testbed needs to be reverted before running test
+
+    This mirrors the condition in adt-run's Testbed.reset().
+    '''
+    recommends = 'needs-recommends' in test.restrictions
+    return (modified or recommends_installed != recommends or
+            bool([d for d in deps_installed if d not in test.depends]))
+
+
+def count_reverts(tests, order, deps_installed=[], recommends_installed=False,
+                  modified=False):
+    '''Count testbed reverts for running tests in given order
+
+    @order: list of indexes into tests
+    @deps_installed, @recommends_installed, @modified: initial testbed state
+    '''
+    reverts = 0
+    for i in order:
+        t = tests[i]
+        if _needs_revert(deps_installed, recommends_installed, modified, t):
+            reverts += 1
+        deps_installed = t.depends
+        recommends_installed = 'needs-recommends' in t.restrictions
+        modified = 'breaks-testbed' in t.restrictions
+    return reverts
+
+
+def schedule_tests(tests, deps_installed=[], recommends_installed=False,
+                   modified=False):
+    '''Group and order tests to minimise the number of testbed reverts
+
+    A test can run right after another one without reverting the testbed if
+    it needs the same recommends setting and (a superset of) the same
+    dependencies, and the previous test does not break the testbed. Tests
+    with equal dependencies are grouped together, and groups are arranged
+    into the smallest possible number of such chains. Within a group, tests
+    keep their relative order, except that isolation-* tests (which might
+    leave services running) come last; breaks-testbed tests always end a
+    chain.
+
+    @deps_installed, @recommends_installed, @modified: initial testbed state;
+    a chain which can start without a revert is scheduled first, the others
+    in the order of their first test.
+
+    Return a list of chains, each a list of indexes into tests.
+    '''
+    # nodes: [(frozenset(depends), recommends), [test indexes], ends_chain]
+    nodes = []
+    groups = {}
+    for (i, t) in enumerate(tests):
+        key = (frozenset(t.depends), 'needs-recommends' in t.restrictions)
+        if 'breaks-testbed' in t.restrictions:
+            nodes.append((key, [i], True))
+        elif key in groups:
+            nodes[groups[key]][1].append(i)
+        else:
+            groups[key] = len(nodes)
+            nodes.append((key, [i], False))
+    for (key, indexes, ends_chain) in nodes:
+        indexes.sort(key=lambda i: [r for r in tests[i].restrictions
+                                    if r.startswith('isolation-')] != [])
+
+    def can_follow(a, b):
+        (ka, kb) = (nodes[a][0], nodes[b][0])
+        return a != b and not nodes[a][2] and ka[1] == kb[1] and ka[0] <= kb[0]
+
+    # "can follow" is a transitive relation, so the minimal number of chains
+    # is len(nodes) - size of a maximum matching of predecessors/successors
+    pred = [None] * len(nodes)
+
+    def augment(a, seen):
+        for b in range(len(nodes)):
+            if b not in seen and can_follow(a, b):
+                seen.add(b)
+                if pred[b] is None or augment(pred[b], seen):
+                    pred[b] = a
+                    return True
+        return False
+
+    for a in range(len(nodes)):
+        augment(a, set())
+
+    succ = dict((a, b) for (b, a) in enumerate(pred) if a is not None)
+    chains = []
+    for head in range(len(nodes)):
+        if pred[head] is not None:
+            continue
+        chain = []
+        n = head
+        while n is not None:
+            chain += nodes[n][1]
+            n = succ.get(n)
+        chains.append(chain)
+
+    chains.sort(key=min)
+    for (ci, chain) in enumerate(chains):
+        if not _needs_revert(deps_installed, recommends_installed, modified,
+                             tests[chain[0]]):
+            chains.insert(0, chains.pop(ci))
+            break
+    return chains
+
 #
 # Parsing for Debian source packages
 #
@@ -242,28 +351,134 @@ def _debian_build_deps_from_source(srcdir, testbed_arch):
             deps += ', ' + st['Build-depends-indep']
 
     # resolve arch specific dependencies and build profiles
-    perl = subprocess.Popen(['perl', '-'], stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE)
-    code = '''use Dpkg::Deps;
-              $dep = deps_parse('%s', reduce_arch => 1, reduce_profiles => 1,
-                                build_dep => 1, host_arch => '%s');
-              print $dep->output(), "\\n";
-              ''' % (deps, testbed_arch)
-    deps = perl.communicate(code.encode('UTF-8'))[0].decode('UTF-8').strip()
-    if perl.returncode != 0:
-        raise InvalidControl('source', 'Invalid build dependencies')
-
-    deps = [d.strip() for d in deps.split(',')]
+    try:
+        deps = list(reduce_deps(deps, testbed_arch, build_dep=True))
+    except ValueError as e:
+        raise InvalidControl('source', 'Invalid build dependencies: %s' % e)
 
     # @builddeps@ should always imply build-essential
     deps.append('build-essential')
     return deps
 
 
+#
+# Debian dependency parsing and reduction
+#
+
+# grammar of a single dependency; dep_re (for test dependencies) and
+# _dep_full_re (for reduce_deps()) are built from these
+_dep_package = r'(?P<package>[a-z0-9+-.]+)'
+_dep_version = r'(\((?P<relation><<|<=|>=|=|>>|<|>)\s*(?P<version>[^\)]*)\))?'
+_dep_arches = r'(\[(?P<arches>[a-z0-9+-. !]+)\])?'
+
 dep_re = re.compile(
-    r'(?P<package>[a-z0-9+-.]+)(?::native)?\s*'
-    r'(\((?P<relation><<|<=|>=|=|>>)\s*(?P<version>[^\)]*)\))?'
-    r'(\s*\[[[a-z0-9+-. ]+\])?$')
+    _dep_package + r'(?::native)?\s*' + _dep_version +
+    r'(\s*' + _dep_arches + r')?$')
+
+_dep_full_re = re.compile(
+    _dep_package + r'(?::(?P<archqual>[a-z0-9-]+))?\s*' + _dep_version +
+    r'\s*' + _dep_arches + r'\s*(?P<profiles>(<[^<>]+>\s*)*)$')
+
+# architectures whose CPU name in dpkg's cputable differs from the arch name
+_arch_cpu = {'armel': 'arm', 'armhf': 'arm', 'x32': 'amd64',
+             'powerpcspe': 'powerpc'}
+
+
+def _debarch_is(arch, pattern):
+    '''Check if Debian architecture matches an architecture (wildcard) pattern
+
+    This is a simplified version of dpkg's debarch_is() which understands
+    "any", "<os>-any", and "any-<cpu>".
+    '''
+    if pattern in ('any', arch):
+        return True
+    if 'any' not in pattern.split('-'):
+        return False
+
+    def split(a):
+        (os_name, cpu) = ('-' in a) and a.rsplit('-', 1) or ('linux', a)
+        return (os_name, _arch_cpu.get(cpu, cpu))
+
+    (os_name, cpu) = split(arch)
+    (pattern_os, pattern_cpu) = split(pattern)
+    return pattern_os in ('any', os_name) and pattern_cpu in ('any', cpu)
+
+
+def _dep_arch_matches(arches, arch):
+    '''Evaluate a dependency's [arch list] for given architecture'''
+
+    negated = [a[1:] for a in arches if a.startswith('!')]
+    if negated:
+        if len(negated) != len(arches):
+            raise ValueError('mixed positive and negated architectures in '
+                             '[%s]' % ' '.join(arches))
+        return not [a for a in negated if _debarch_is(arch, a)]
+    return bool([a for a in arches if _debarch_is(arch, a)])
+
+
+def _dep_profiles_match(formula):
+    '''Evaluate a dependency's <profile> <restrictions>
+
+    No build profiles are active, so "!profile" terms are true and "profile"
+    terms are false. Restriction lists are ORed, their terms are ANDed.
+    '''
+    for term_list in re.findall(r'<([^<>]*)>', formula):
+        if not [t for t in term_list.split() if not t.startswith('!')]:
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def reduce_deps(deps, arch, build_dep=False):
+    '''Parse and reduce a Debian dependency string for an architecture
+
+    This drops alternatives with [arch] lists which don't match arch (and
+    dependencies which have no alternatives left), and removes the arch
+    lists. If build_dep is True, build profile <restrictions> are evaluated
+    in the same way, with no build profiles being active. Relations are
+    normalized ("<" and ">" are obsolete spellings of "<=" and ">=").
+
+    This does the same as perl's Dpkg::Deps::deps_parse() with reduce_arch
+    (and reduce_profiles), without the cost of starting perl; results are
+    cached, as this gets called with the same arguments a lot.
+
+    Return a tuple of reduced dependencies, i. e. alternatives joined by
+    " | ". Raise ValueError on invalid dependencies.
+    '''
+    result = []
+    for group in deps.split(','):
+        group = group.strip()
+        if not group:
+            continue
+        alternatives = []
+        for dep in group.split('|'):
+            dep = dep.strip()
+            m = _dep_full_re.match(dep)
+            if not m:
+                raise ValueError('invalid dependency "%s"' % dep)
+            if m.group('arches') is not None and \
+                    not _dep_arch_matches(m.group('arches').split(), arch):
+                continue
+            profiles = m.group('profiles').strip()
+            if build_dep and profiles and not _dep_profiles_match(profiles):
+                continue
+
+            d = m.group('package')
+            if m.group('archqual'):
+                d += ':' + m.group('archqual')
+            if m.group('relation'):
+                relation = m.group('relation')
+                relation = {'<': '<=', '>': '>='}.get(relation, relation)
+                version = m.group('version').strip()
+                if not version:
+                    raise ValueError('missing version in "%s"' % dep)
+                d += ' (%s %s)' % (relation, version)
+            if profiles and not build_dep:
+                d += ' ' + ' '.join(re.findall(r'<[^<>]*>', profiles))
+            alternatives.append(d)
+        if alternatives:
+            result.append(' | '.join(alternatives))
+    return tuple(result)
 
 
 def _debian_check_dep(testname, dep):